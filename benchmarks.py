@@ -0,0 +1,538 @@
+import importlib
+import inspect
+import json
+import logging
+import random
+import re
+import statistics
+import sys
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from threading import Lock, Thread
+from time import monotonic, perf_counter, sleep, time
+from unittest.mock import patch
+from urllib.parse import parse_qs, urlsplit
+
+import bot3 as bot
+from source import circuit_breakers, commands, database, discord_apis, exceptions, json_codec, make_request, reconcile, recording, src_apis, twitch_apis
+from source.records import AnnouncedStream, Stream
+
+# Benchmarks for the bot's hot paths. Unlike tests.py, these don't assert anything, they just report how long things take.
+# Run all benchmarks with `python benchmarks.py`, or specific ones with `python benchmarks.py benchDiffStreams`.
+
+def synthetic_helix_stream(i, game_count=10):
+  # The shape of a stream from the Helix /streams API, see https://dev.twitch.tv/docs/api/reference/#get-streams
+  name = f'runner{i}'
+  return {
+    'id': str(40000000000 + i),
+    'user_id': str(100000 + i),
+    'user_login': name,
+    'user_name': name,
+    'game_id': f't{i % game_count}',
+    'game_name': f'game{i % game_count}',
+    'type': 'live',
+    'title': f'{name} any% attempts',
+    'tags': ['English', 'Speedrun'],
+    'viewer_count': i,
+    'started_at': '2026-10-18T12:00:00Z',
+    'language': 'en',
+    'thumbnail_url': f'https://static-cdn.jtvnw.net/previews-ttv/live_user_{name}-{{width}}x{{height}}.jpg',
+    'tag_ids': [],
+    'is_mature': False,
+  }
+
+def synthetic_stream(i, game_count=10):
+  return Stream.from_helix(synthetic_helix_stream(i, game_count))
+
+def synthetic_announced_stream(i, game_count=10):
+  stream = synthetic_stream(i, game_count)
+  return AnnouncedStream(
+    name=stream.name,
+    game=stream.game,
+    title=stream.title,
+    url=stream.url,
+    preview=stream.preview,
+    channel_id=1000 + i % game_count,
+    message_id=2000 + i,
+    start=0,
+    preview_expires=100 if i % 7 else 0, # Some previews have expired
+  )
+
+def legacy_stream_dict(stream):
+  # How get_live_streams represented streams before records.Stream, for comparison.
+  return {
+    'preview': stream['thumbnail_url'].format(width=1920, height=1080),
+    'url': 'https://www.twitch.tv/' + stream['user_name'],
+    'name': stream['user_name'],
+    'title': stream['title'],
+    'viewcount': stream['viewer_count'],
+    'game': stream['game_name'],
+    'twitch_game_id': stream['game_id'],
+  }
+
+def measure_allocations(func):
+  # Returns (peak bytes allocated while running func, bytes still allocated by its result)
+  tracemalloc.start()
+  tracemalloc.reset_peak()
+  result = func()
+  retained, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  del result
+  return peak, retained
+
+def timeit(func, iterations):
+  start = perf_counter()
+  for _ in range(iterations):
+    func()
+  return (perf_counter() - start) / iterations
+
+
+# Local stand-ins for the Helix, speedrun.com and Discord REST APIs, so that whole ticks can be benchmarked without touching the network.
+# Each server answers from a SyntheticWorld, and can inject latency, rate limits (429) and server errors (502).
+class FakeApi(ThreadingHTTPServer):
+  daemon_threads = True
+
+  def __init__(self, routes, latency=0, rate_limit=None, error_every=0):
+    super().__init__(('127.0.0.1', 0), FakeApiHandler)
+    self.routes = [(method, re.compile(path), handler) for method, path, handler in routes]
+    self.latency = latency # Seconds before each response
+    self.rate_limit = rate_limit # Requests per second, past which we return 429
+    self.error_every = error_every # Every Nth request fails with a 502
+    self.lock = Lock()
+    self.requests = Counter() # route: count
+    self.errors = Counter() # status: count
+    self.window_start = 0
+    self.window_requests = 0
+    Thread(target=self.serve_forever, daemon=True).start()
+
+  @property
+  def url(self):
+    return f'http://127.0.0.1:{self.server_address[1]}'
+
+  def get_error(self):
+    with self.lock:
+      now = monotonic()
+      if now >= self.window_start + 1:
+        self.window_start = now
+        self.window_requests = 0
+      self.window_requests += 1
+      if self.rate_limit and self.window_requests > self.rate_limit:
+        status = 429
+      elif self.error_every and sum(self.requests.values()) % self.error_every == 0:
+        status = 502
+      else:
+        return None
+      self.errors[status] += 1
+      return status
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
+
+
+class FakeApiHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1' # Keep-alive, like the real APIs
+  disable_nagle_algorithm = True # Otherwise, each response waits on a delayed ACK
+
+  def handle_request(self):
+    parts = urlsplit(self.path)
+    query = parse_qs(parts.query)
+    body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+    body = json.loads(body) if body else None
+
+    for method, path, handler in self.server.routes:
+      if method == self.command and (match := path.fullmatch(parts.path)):
+        break
+    else:
+      return self.respond(404, {'status': 404, 'message': f'No route for {self.command} {parts.path}'})
+
+    with self.server.lock:
+      self.server.requests[f'{method} {path.pattern}'] += 1
+    if self.server.latency:
+      sleep(self.server.latency)
+    if status := self.server.get_error():
+      return self.respond(status, {'status': status, 'message': 'Injected error'}, {'Retry-After': '1'})
+    self.respond(*handler(match, query, body))
+
+  def respond(self, status, j=None, headers=None):
+    data = json.dumps(j).encode('utf-8') if j is not None else b''
+    self.send_response(status)
+    for key, value in (headers or {}).items():
+      self.send_header(key, value)
+    if status != 204:
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    if self.command != 'HEAD':
+      self.wfile.write(data)
+
+  do_GET = do_POST = do_PATCH = do_PUT = do_DELETE = do_HEAD = handle_request
+
+  def log_message(self, format, *args):
+    pass
+
+
+class SyntheticWorld:
+  """
+  N tracked games (half of which are also moderated), M live streams spread across those games, of which the first K are speedrunners.
+  Call churn() between ticks to make some streams go offline or come online, change titles, and submit or verify runs.
+  """
+  def __init__(self, games, streams, runners, runs_per_game=5, seed=0):
+    self.games = games
+    self.runners = runners
+    self.random = random.Random(seed)
+    self.live = {i: f'attempts #{i}' for i in range(streams)} # stream index: title
+    self.next_stream = streams
+    self.new_runs = {game: [f'run{game}x{i}' for i in range(runs_per_game)] for game in range(games)} # game index: unverified run ids
+    self.next_run = runs_per_game
+    self.next_message_id = 1
+    self.lock = Lock()
+
+  def churn(self, fraction=0.05):
+    count = max(1, int(len(self.live) * fraction))
+    for i in self.random.sample(list(self.live), count):
+      del self.live[i] # Offline
+    for i in self.random.sample(list(self.live), count):
+      self.live[i] += ' (new title)'
+    for _ in range(count):
+      self.live[self.next_stream] = f'attempts #{self.next_stream}'
+      self.next_stream += 1
+    for runs in self.new_runs.values():
+      if runs and self.random.random() < fraction * 4:
+        runs.pop(0) # Verified
+      if self.random.random() < fraction * 4:
+        runs.append(f'run{self.next_run}')
+        self.next_run += 1
+
+  # Helix
+  def helix_stream(self, i, helix):
+    stream = synthetic_helix_stream(i, self.games)
+    stream['game_id'] = f'{1000 + i % self.games}'
+    stream['game_name'] = f'Game {i % self.games}'
+    stream['title'] = self.live[i]
+    stream['thumbnail_url'] = f'{helix.url}/previews/live_user_runner{i}-{{width}}x{{height}}.jpg'
+    return stream
+
+  def get_streams(self, helix, query):
+    game_ids = set(query.get('game_id', []))
+    user_logins = set(query.get('user_login', []))
+    streams = [i for i in list(self.live) if f'{1000 + i % self.games}' in game_ids or f'runner{i}' in user_logins]
+    start = int(query.get('after', [0])[0])
+    page = streams[start:start + int(query['first'][0])]
+    cursor = str(start + len(page)) if start + len(page) < len(streams) else None
+    return 200, {'data': [self.helix_stream(i, helix) for i in page], 'pagination': {'cursor': cursor} if cursor else {}}
+
+  def get_preview(self, match):
+    if int(match[1]) in self.live:
+      return 200, None, {'Expires': formatdate(time() + 5 * 60, usegmt=True)} # Twitch previews are cached for 5 minutes
+    return 302, None, {'Location': '/previews/404_preview.jpg', 'Expires': formatdate(time() + 5 * 60, usegmt=True)}
+
+  # speedrun.com
+  def src_game(self, game):
+    return {'id': f'srcgame{game}', 'names': {'international': f'Game {game}', 'twitch': f'Game {game}'}, 'abbreviation': f'g{game}', 'links': []}
+
+  def src_run(self, run_id, game, runner, src):
+    return {
+      'id': run_id,
+      'weblink': f'{src.url}/run/{run_id}',
+      'game': {'data': self.src_game(game)},
+      'level': {'data': []},
+      'category': {'data': {'id': 'anypercent', 'name': 'Any%', 'variables': {'data': []}}},
+      'values': {},
+      'players': {'data': [{'rel': 'user', 'id': f'srcuser{runner}', 'names': {'international': f'runner{runner}'}}]},
+      'times': {'primary_t': 3600 + runner},
+      'submitted': '2026-10-18T12:00:00Z',
+      'status': {'status': 'new'},
+    }
+
+  def get_src_user(self, query):
+    name = query['twitch'][0]
+    i = int(name.removeprefix('runner'))
+    return 200, {'data': [{'id': f'srcuser{i}', 'names': {'international': name}}] if i < self.runners else []}
+
+  def get_personal_bests(self, match, query, src):
+    i = int(match[1])
+    run = self.src_run(f'pb{i}', i % self.games, i, src)
+    entry = {'place': 1 + i % 10, 'run': dict(run, game=f'srcgame{i % self.games}')}
+    if 'embed' in query:
+      entry.update({key: run[key] for key in ['game', 'level', 'category', 'players']})
+    return 200, {'data': [entry]}
+
+  def get_runs(self, query, src):
+    game = int(query['game'][0].removeprefix('srcgame'))
+    runs = [self.src_run(run_id, game, self.runners + j, src) for j, run_id in enumerate(self.new_runs.get(game, []))]
+    return 200, {'data': runs, 'pagination': {'links': []}}
+
+  def get_run(self, match, src):
+    run_id = match[1]
+    status = 'new' if any(run_id in runs for runs in self.new_runs.values()) else 'verified'
+    return 200, {'data': dict(self.src_run(run_id, 0, 0, src), status={'status': status})}
+
+  def get_leaderboard(self, match):
+    return 200, {'data': {'runs': [{'place': place, 'run': {'times': {'primary_t': 3000 + 100 * place}, 'players': [{'rel': 'user', 'id': f'srcuser{place}'}]}} for place in range(1, 21)]}}
+
+  # Discord
+  def send_message(self, match):
+    with self.lock:
+      self.next_message_id += 1
+      return 200, {'id': str(self.next_message_id), 'channel_id': match[1]}
+
+
+def fake_apis(world, **kwargs):
+  # Returns (helix, src, discord) servers for the world, which all share the same error injection settings (see FakeApi).
+  helix = FakeApi([
+    ('POST', '/oauth2/token', lambda match, query, body: (200, {'access_token': 'benchmark', 'expires_in': 60 * 24 * 60 * 60})),
+    ('GET', '/helix/streams', lambda match, query, body: world.get_streams(helix, query)),
+    ('HEAD', r'/previews/live_user_runner(\d+)-1920x1080\.jpg', lambda match, query, body: world.get_preview(match)),
+  ], **kwargs)
+  src = FakeApi([
+    ('GET', '/api/v1/users', lambda match, query, body: world.get_src_user(query)),
+    ('GET', r'/api/v1/users/srcuser(\d+)/personal-bests', lambda match, query, body: world.get_personal_bests(match, query, src)),
+    ('GET', '/api/v1/games', lambda match, query, body: (200, {'data': [world.src_game(int(query['name'][0].removeprefix('Game ')))]})),
+    ('GET', '/api/v1/runs', lambda match, query, body: world.get_runs(query, src)),
+    ('GET', r'/api/v1/runs/(\w+)', lambda match, query, body: world.get_run(match, src)),
+    ('HEAD', r'/run/(\w+)', lambda match, query, body: (200, None)),
+    ('GET', r'/api/v1/leaderboards/(\w+)/category/(\w+)', lambda match, query, body: world.get_leaderboard(match)),
+  ], **kwargs)
+  discord = FakeApi([
+    ('POST', r'/api/v9/channels/(\d+)/messages', lambda match, query, body: world.send_message(match)),
+    ('PATCH', r'/api/v9/channels/(\d+)/messages/(\d+)', lambda match, query, body: (200, {'id': match[2]})),
+    ('PUT', r'/api/v9/channels/(\d+)/messages/(\d+)/reactions/.+/@me', lambda match, query, body: (204, None)),
+    ('DELETE', r'/api/v9/channels/(\d+)/messages/(\d+)/reactions/.+/@me', lambda match, query, body: (204, None)),
+  ], **kwargs)
+  return helix, src, discord
+
+
+@contextmanager
+def run_against(world, helix, src, discord):
+  """
+  Point the bot at the fake servers, with a fresh (in-memory) database containing the world's games.
+  Sleeps inside make_request (retry and backoff delays) are scaled down 100x, so that injected errors don't dominate the run time.
+  """
+  database.conn.close()
+  with patch.dict('os.environ', {'SPEEDRUNBOT_DATABASE': ':memory:'}):
+    importlib.reload(database) # Not the bot's database, which is left alone
+  commands.response_cache.clear()
+  bot.new_run_intervals.next_poll.clear()
+  src_apis.non_runners.window_start = 0
+  make_request.backoff = 1
+  circuit_breakers.breakers.clear()
+  twitch_apis.client_credentials = ('benchmark', 'benchmark')
+  twitch_apis.cached_headers = (None, 0)
+  discord_apis.cached_headers = {'Authorization': 'Bot benchmark'}
+
+  for game in range(world.games):
+    database.add_game(f'Game {game}', f'{1000 + game}', f'srcgame{game}', 5000 + game)
+    if game % 2 == 0:
+      database.moderate_game(f'Game {game}', f'srcgame{game}', 5000 + game)
+    database.set_game_series(f'srcgame{game}', src_apis.SRC_NO_SERIES) # As if warm_game_series had already run
+
+  def scaled_sleep(seconds):
+    sleep(seconds / 100)
+
+  with (patch('source.make_request.sleep', new=scaled_sleep),
+        patch('source.twitch_apis.api', new=f'{helix.url}/helix'),
+        patch('source.twitch_apis.token_api', new=f'{helix.url}/oauth2/token'),
+        patch('source.src_apis.api', new=f'{src.url}/api/v1'),
+        patch('source.src_apis.host', new=urlsplit(src.url).netloc),
+        patch('source.discord_apis.api', new=f'{discord.url}/api/v9')):
+    yield
+
+
+def run_ticks(world, ticks):
+  # Returns ({job name: [seconds per tick]}, number of ticks which failed)
+  durations = {'announce_live_channels': [], 'announce_new_runs': [], 'commands': []}
+  failed_ticks = 0
+  for tick in range(ticks):
+    for name, func in [('announce_live_channels', bot.announce_live_channels), ('announce_new_runs', bot.announce_new_runs), ('commands', lambda: run_commands(world))]:
+      start = perf_counter()
+      try:
+        func()
+      except exceptions.NetworkError:
+        failed_ticks += 1 # The scheduler would retry these with backoff
+      durations[name].append(perf_counter() - start)
+    world.churn()
+    bot.new_run_intervals.next_poll.clear() # Poll every moderated game, every tick
+  return durations, failed_ticks
+
+
+def print_durations(label, durations):
+  print(f'{label}:')
+  for name, times in durations.items():
+    print(f'  {name}: median {statistics.median(times) * 1000:.1f} ms, max {max(times) * 1000:.1f} ms')
+
+
+def benchmark_ticks(label, world, ticks, **kwargs):
+  servers = fake_apis(world, **kwargs)
+  with run_against(world, *servers):
+    durations, failed_ticks = run_ticks(world, ticks)
+    peak, _ = measure_allocations(bot.announce_live_channels)
+
+  print_durations(label, durations)
+  print(f'  {len(database.get_announced_streams())} announced streams, {failed_ticks} failed ticks, {peak / 1024:.0f} KiB peak during one more announce_live_channels')
+  for server_name, server in zip(['helix', 'src', 'discord'], servers):
+    requests = ', '.join(f'{route} x{count}' for route, count in server.requests.most_common())
+    errors = ''.join(f', {count} x {status}' for status, count in server.errors.items())
+    print(f'  {server_name}: {sum(server.requests.values())} requests{errors} ({requests})')
+    server.stop()
+
+
+def run_commands(world):
+  # A handful of users running commands in a tracked channel, including repeated !pb lookups of the same (live) runner.
+  for i, content in enumerate(['!about', '!help', '!pb runner0', '!pb runner0', f'!pb runner{world.runners - 1}', '!unknown_command']):
+    message = {
+      'id': str(9000 + i),
+      'channel_id': '5000',
+      'author': {'id': 'benchmark_user'},
+      'content': content,
+      'mentions': [],
+    }
+    bot.on_message(message)
+
+
+class Benchmarks:
+  def benchDiffStreams(self):
+    for count in [100, 1_000, 10_000]:
+      announced_streams = [synthetic_announced_stream(i) for i in range(count)]
+      # A typical tick: most streams are unchanged, a few go offline, go live, change title, or change games.
+      live_streams = {}
+      for i in range(count):
+        stream = synthetic_stream(i)
+        if i % 20 == 0:
+          continue # Offline
+        elif i % 20 == 1:
+          stream.title = 'new title'
+        elif i % 20 == 2:
+          stream.game = 'another game'
+        live_streams[stream.name] = stream
+      for i in range(count, count + count // 20):
+        live_streams[f'runner{i}'] = synthetic_stream(i) # Newly live
+
+      actions = reconcile.diff_streams(announced_streams, live_streams, 50)
+      duration = timeit(lambda: reconcile.diff_streams(announced_streams, live_streams, 50), 20)
+      print(f'diff_streams with {count} streams: {duration * 1000:.2f} ms ({len(actions)} actions)')
+
+  def benchTickAllocations(self):
+    count = 1_000
+    # Helix returns 100 streams per page, as JSON. Decoding is part of every tick, whatever we convert the streams into.
+    pages = [json.dumps({'data': [synthetic_helix_stream(i) for i in range(start, start + 100)]}) for start in range(0, count, 100)]
+    announced_streams = [synthetic_announced_stream(i) for i in range(count)]
+
+    def tick(convert):
+      live_streams = {}
+      for page in pages:
+        for stream in json.loads(page)['data']:
+          stream = convert(stream)
+          live_streams[stream.name if isinstance(stream, Stream) else stream['name']] = stream
+      return live_streams
+
+    for label, convert in [('dicts', legacy_stream_dict), ('records', Stream.from_helix)]:
+      peak, retained = measure_allocations(lambda: tick(convert))
+      print(f'Polling {count} live streams as {label}: {peak / 1024:.0f} KiB peak, {retained / 1024:.0f} KiB retained after the tick')
+
+    live_streams = tick(Stream.from_helix)
+    peak, retained = measure_allocations(lambda: reconcile.diff_streams(announced_streams, live_streams, 50))
+    print(f'Diffing {count} live streams: {peak / 1024:.0f} KiB peak, {retained / 1024:.0f} KiB retained')
+
+  def benchEndToEnd(self):
+    bot.client.user = {'id': 'benchmark_bot'}
+    logging.disable() # Injected errors are logged (with tracebacks), which would bury the results. They're counted instead.
+    for games, streams, runners in [(10, 100, 50), (50, 1_000, 300)]:
+      benchmark_ticks(f'{games} games, {streams} streams, {runners} runners', SyntheticWorld(games, streams, runners), ticks=5)
+    benchmark_ticks('10 games, 100 streams, 50 runners, 20 ms latency', SyntheticWorld(10, 100, 50), ticks=5, latency=0.02)
+    benchmark_ticks('10 games, 100 streams, 50 runners, 1 in 50 requests fail', SyntheticWorld(10, 100, 50), ticks=5, error_every=50)
+    benchmark_ticks('10 games, 100 streams, 50 runners, rate limited to 100/s', SyntheticWorld(10, 100, 50), ticks=5, rate_limit=100)
+
+  def benchReplay(self):
+    # Record a few ticks against the fake servers, then replay them (without using the servers), with and without the recorded latency.
+    # Real traffic can be recorded by running the bot with --record, and replayed the same way (starting from a copy of the bot's database).
+    bot.client.user = {'id': 'benchmark_bot'}
+    logging.disable()
+    path = Path(__file__).with_name('benchmark_recording.jsonl.gz')
+    path.unlink(missing_ok=True)
+    world = SyntheticWorld(10, 100, 50)
+    servers = fake_apis(world, latency=0.01)
+    try:
+      with run_against(world, *servers):
+        recording.start(recording.Recorder(path))
+        durations, _ = run_ticks(world, 5)
+        recording.stop()
+      print_durations(f'Recorded with 10 ms latency ({path.stat().st_size / 1024:.0f} KiB archive)', durations)
+
+      for latency_scale in [1, 0]:
+        world = SyntheticWorld(10, 100, 50) # Same seed, so the same commands are run
+        with run_against(world, *servers):
+          replayer = recording.start(recording.Replayer(path, latency_scale))
+          durations, _ = run_ticks(world, 5)
+          recording.stop()
+        print_durations(f'Replayed with {latency_scale}x latency ({replayer.replayed} requests replayed, {replayer.missed} not found)', durations)
+    finally:
+      recording.stop()
+      for server in servers:
+        server.stop()
+      path.unlink(missing_ok=True)
+
+  def benchJsonCodec(self):
+    # Decode and re-encode recorded response bodies with each JSON backend. Uses the newest recording from --record if there is one,
+    # otherwise records a few ticks against the fake servers (whose payloads are smaller than the real APIs', so the gain is understated).
+    recordings = sorted(Path(__file__).parent.glob('recording-*.jsonl.gz'))
+    path = recordings[-1] if recordings else Path(__file__).with_name('benchmark_recording.jsonl.gz')
+    try:
+      if not recordings:
+        bot.client.user = {'id': 'benchmark_bot'}
+        logging.disable()
+        world = SyntheticWorld(50, 1_000, 300)
+        servers = fake_apis(world)
+        try:
+          with run_against(world, *servers):
+            recording.start(recording.Recorder(path))
+            run_ticks(world, 3)
+        finally:
+          recording.stop()
+          for server in servers:
+            server.stop()
+
+      bodies = {} # endpoint: [encoded response bodies]
+      for entries in recording.Replayer(path, 0).responses.values():
+        for entry in entries:
+          if entry.get('json') is not None:
+            _, endpoint = make_request.get_endpoint(entry['key'][1])
+            bodies.setdefault(endpoint, []).append(json.dumps(entry['json']).encode('utf-8'))
+      # The gateway isn't recorded, so use typical MESSAGE_CREATE frames
+      message = {'id': '1234567890123456789', 'channel_id': '1234567890123456789', 'content': '!streams', 'author': {'id': '1234567890123456789', 'username': 'runner'}}
+      bodies['gateway MESSAGE_CREATE'] = [json.dumps({'op': 0, 't': 'MESSAGE_CREATE', 's': i, 'd': message}) for i in range(1_000)]
+      print(f'Using {path.name if recordings else "a recording of the fake servers"}, backends: {", ".join(json_codec.BACKENDS)}')
+
+      largest = sorted(bodies, key=lambda endpoint: sum(len(body) for body in bodies[endpoint]), reverse=True)[:6]
+      for endpoint in largest:
+        encoded = bodies[endpoint]
+        decoded = [json.loads(body) for body in encoded]
+        results = []
+        for backend in json_codec.BACKENDS:
+          json_codec.use(backend)
+          decode = timeit(lambda: [json_codec.loads(body) for body in encoded], 20)
+          encode = timeit(lambda: [json_codec.dumps_bytes(value) for value in decoded], 20)
+          results.append(f'{backend} decode {decode * 1000:.2f} ms, encode {encode * 1000:.2f} ms')
+        print(f'{endpoint} ({len(encoded)} bodies, {sum(len(body) for body in encoded) / 1024:.0f} KiB): ' + '; '.join(results))
+    finally:
+      json_codec.use('orjson' if json_codec.orjson else 'json')
+      if not recordings:
+        path.unlink(missing_ok=True)
+
+
+if __name__ == '__main__':
+  benchmarks = Benchmarks()
+  def is_benchmark(method):
+    return inspect.ismethod(method) and method.__name__.startswith('bench')
+  benchmarks = list(inspect.getmembers(benchmarks, is_benchmark))
+  benchmarks.sort(key=lambda func: func[1].__code__.co_firstlineno)
+
+  for benchmark in benchmarks:
+    if len(sys.argv) > 1 and benchmark[0] not in sys.argv[1:]:
+      continue
+    print('---', benchmark[0])
+    benchmark[1]()
@@ -0,0 +1,127 @@
+import logging
+from collections import deque
+from threading import Lock
+from time import monotonic
+
+from . import exceptions, metrics
+
+# When an upstream is down, every call to it would otherwise wait for a timeout (and a retry) before failing, which multiplies tick times
+# and floods the logs. Instead, make_request tracks each host's recent requests, and once too many of them fail, it fails fast for a while.
+# Callers treat CircuitOpen like any other NetworkError, but without logging a traceback, and fall back to cached data where they can.
+
+CLOSED = 0 # Requests are sent as usual
+OPEN = 1 # Requests fail immediately
+HALF_OPEN = 2 # One probe request is sent, to find out if the host has recovered
+NAMES = ['closed', 'open', 'half-open']
+
+circuit_state = metrics.gauge('circuit_state', 'State of the circuit breaker for each host (0 closed, 1 open, 2 half-open)')
+rejected_requests = metrics.counter('circuit_rejected_total', 'Requests which were not sent because the host\'s circuit breaker was open, by host')
+
+class CircuitBreaker():
+  """
+  Opens once at least failure_rate of the last window requests (and at least min_calls) failed, where a failure is a connection error,
+  a 5xx, or a response slower than slow_seconds. After open_seconds, a single probe request is let through: if it succeeds the breaker
+  closes, otherwise it opens again for twice as long (up to max_open_seconds).
+  """
+  def __init__(self, host, window=20, min_calls=5, failure_rate=0.5, slow_seconds=10, open_seconds=30, max_open_seconds=600):
+    self.host = host
+    self.min_calls = min_calls
+    self.failure_rate = failure_rate
+    self.slow_seconds = slow_seconds
+    self.open_seconds = open_seconds
+    self.max_open_seconds = max_open_seconds
+    self.results = deque(maxlen=window) # True for each failed request
+    self.state = CLOSED
+    self.opened_at = 0
+    self.wait = open_seconds # How long the breaker stays open this time
+    self.probing = False # Whether the half-open probe is in flight
+    self.lock = Lock()
+
+    # Stats
+    self.opens = 0
+    self.rejected = 0
+
+  def set_state(self, state, now):
+    self.state = state
+    circuit_state.set(state, host=self.host)
+    if state == OPEN:
+      self.opened_at = now
+      self.opens += 1
+      logging.warning('%s is failing, not sending requests to it for %d seconds', self.host, self.wait)
+    elif state == CLOSED:
+      logging.info('%s has recovered', self.host)
+
+  def is_open(self, now=None):
+    # Whether a request would be rejected right now. Use this to skip optional work, since it does not start a probe.
+    if now is None:
+      now = monotonic()
+    with self.lock:
+      if self.state == OPEN:
+        return now < self.opened_at + self.wait
+      return self.state == HALF_OPEN and self.probing
+
+  def check(self, now=None):
+    # Call before sending a request. Raises CircuitOpen if it should not be sent. Otherwise, returns whether the request is the probe,
+    # which should be passed to record (or release) once the request is done.
+    if now is None:
+      now = monotonic()
+    with self.lock:
+      if self.state == OPEN and now >= self.opened_at + self.wait:
+        self.set_state(HALF_OPEN, now)
+      if self.state == CLOSED:
+        return False
+      if self.state == HALF_OPEN and not self.probing:
+        self.probing = True
+        return True
+      self.rejected += 1
+      retry_in = max(0, self.opened_at + self.wait - now)
+    rejected_requests.inc(host=self.host)
+    raise exceptions.CircuitOpen(f'{self.host} is failing, not sending requests to it for another {retry_in:.0f} seconds')
+
+  def record(self, success, seconds, probe=False, now=None):
+    if now is None:
+      now = monotonic()
+    failed = not success or seconds > self.slow_seconds
+    with self.lock:
+      if probe:
+        self.probing = False
+        if failed:
+          self.wait = min(self.max_open_seconds, self.wait * 2)
+          self.set_state(OPEN, now)
+        else:
+          self.wait = self.open_seconds
+          self.results.clear()
+          self.set_state(CLOSED, now)
+        return
+
+      self.results.append(failed)
+      if self.state == CLOSED and len(self.results) >= self.min_calls and sum(self.results) >= len(self.results) * self.failure_rate:
+        self.set_state(OPEN, now)
+
+  def release(self, probe):
+    # The request was never sent, or was cut short by us (e.g. the job's deadline), so it says nothing about the host.
+    if probe:
+      with self.lock:
+        self.probing = False
+
+  def stats(self):
+    return f'{self.host}: {NAMES[self.state]}, opened {self.opens} times, {self.rejected} requests rejected'
+
+
+breakers = {} # host: CircuitBreaker
+breakers_lock = Lock()
+
+def get(host):
+  with breakers_lock:
+    if host not in breakers:
+      breakers[host] = CircuitBreaker(host)
+    return breakers[host]
+
+
+def is_open(host):
+  return get(host).is_open()
+
+
+def get_stats():
+  with breakers_lock:
+    return '\n'.join(breaker.stats() for breaker in breakers.values())
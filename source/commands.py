@@ -1,37 +1,162 @@
-import logging
+import re
+from collections import namedtuple
+from threading import Lock
 
-from . import discord_apis
+from . import database, exceptions, metrics
+from .utils import seconds_since_epoch
 
-register_global_slash_command(
-    'track_game', 'Announce speedrunners of a game when they go live',
-    args={
-      'channel': 'The channel to announce runners in',
-      'game_name': 'The exact name of the game to announce',
-    })
+# A registry of bot commands, shared by text (!command) and slash (/command) invocations.
+# Commands are registered once at import time with @command, so handling a message is just a dictionary lookup.
 
-client.callbacks['track_game'] = track_game
-def track_game(channel, game_name):
-    generics.track_game(game_name, channel['id'])
-    return f'Will now announce runners of {game_name} in channel <#{channel["id"]}>.'
+# Kinds of arguments
+CHANNEL = 'channel' # The channel mentioned in the message (at most one), or else the channel the message was sent in. Does not consume any words.
+WORD = 'word' # A single word
+TEXT = 'text' # All remaining words, joined with spaces (e.g. a game name)
 
+Arg = namedtuple('Arg', ['name', 'kind', 'required', 'description'])
+def arg(name, kind=WORD, required=True, description=None):
+  return Arg(name, kind, required, description or name.replace('_', ' '))
 
+Command = namedtuple('Command', ['name', 'func', 'args', 'admin', 'slow', 'cache_ttl', 'cache_tables', 'cache_rows', 'usage', 'example', 'description'])
+registry = {} # name (without the !): Command
 
+def command(name, *args, admin=False, slow=False, cache_ttl=None, cache_tables=(), cache_rows=None, usage='', example=None, description=''):
+  """
+  Register a command handler. The handler is called as func(message, **args), where args are parsed according to the arg specs.
+  - admin commands are only available to admins (and appear as unknown commands to everyone else)
+  - slow commands (i.e. ones which make network calls) get a reaction while they're processing, so the user knows we've seen them
+  - cache_ttl (seconds) caches the response of read-only commands, see call(). Responses must depend only on the args, and on the database tables in cache_tables.
+    For tables which are written to often, cache_rows(**args) can instead return the (table, row key) pairs which the response depends on.
+  - usage and example are shown to the user if a required arg is missing
+  """
+  def decorator(func):
+    registry[name] = Command(name, func, args, admin, slow, cache_ttl, cache_tables, cache_rows, usage, example, description or func.__name__.replace('_', ' '))
+    return func
+  return decorator
 
 
+# Since mentions can appear anywhere in the message, strip them out entirely for command processing.
+# User and channel mentions can still be accessed via message.mentions and message.channel_mentions
+MENTION = re.compile(r'<(?:@|@&|#)\d{15,20}>') # @member @&role #channel
+# https://github.com/Rapptz/discord.py/blob/master/discord/message.py#L892
+CHANNEL_MENTION = re.compile(r'<#([0-9]{15,20})>')
+# A command is a word starting with !, possibly after some mentions (e.g. "@SpeedrunBot !help")
+COMMAND_START = re.compile(r'(?:\s*<(?:@|@&|#)\d{15,20}>)*\s*!')
 
-"""
-  admin_commands = {
-    '!track_game': lambda: track_game(get_channel(), ' '.join(args[1:])),
-    '!untrack_game': lambda: untrack_game(get_channel(), ' '.join(args[1:])),
-    '!moderate_game': lambda: moderate_game(get_channel(), ' '.join(args[1:])),
-    '!unmoderate_game': lambda: unmoderate_game(get_channel(), ' '.join(args[1:])),
-    '!restart': lambda: restart(*args[1:2]),
-    '!git_update': lambda: git_update(),
-    '!send_last_lines': lambda: send_last_lines(),
-  }
-  commands = {
-    '!announce_me': lambda: announce(get_channel(), *args[1:3]),
-    '!about': lambda: about(),
-    '!help': lambda: help(),
+def is_command(content):
+  return COMMAND_START.match(content) is not None
+
+
+# Returns (command name, remaining words), or (None, None) if the message is not a command.
+def parse(content):
+  if not COMMAND_START.match(content):
+    return None, None # Fast path for the vast majority of messages
+  words = [word for word in content.split() if not MENTION.fullmatch(word)]
+  return words[0][1:], words[1:]
+
+
+def bind_words(command, words, content, channel_id):
+  args = {}
+  i = 0
+  for spec in command.args:
+    if spec.kind == CHANNEL:
+      channel_mentions = CHANNEL_MENTION.findall(content)
+      if len(channel_mentions) > 1:
+        raise exceptions.CommandError('Response mentions more than one channel. Please mention at most one channel name at a time.')
+      value = channel_mentions[0] if channel_mentions else channel_id
+    elif spec.kind == WORD:
+      value = words[i] if i < len(words) else None
+      i += 1
+    elif spec.kind == TEXT:
+      value = ' '.join(words[i:]) or None
+      i = len(words)
+
+    if value is not None:
+      args[spec.name] = value
+  check_required(command, args)
+  return args
+
+
+def bind_options(command, options, channel_id):
+  # Slash command options are already named. Channel options default to the channel the command was used in, as with text commands.
+  args = {option['name']: option['value'] for option in options or []}
+  for spec in command.args:
+    if spec.kind == CHANNEL:
+      args.setdefault(spec.name, channel_id)
+  check_required(command, args)
+  return args
+
+
+def check_required(command, args):
+  if any(spec.required and not args.get(spec.name) for spec in command.args):
+    error = f'Usage of !{command.name}: `!{command.name} {command.usage}`'
+    if command.example:
+      error += f'\nFor example: `!{command.name} {command.example}`'
+    raise exceptions.UsageError(error)
+
+
+# Responses of read-only commands are cached, so that (for example) several people asking for the !pb of a streamer who just went live only costs one set of SRC calls.
+# Entries expire after the command's cache_ttl, or as soon as one of its cache_tables (or cache_rows) is written to.
+response_cache = {} # (name, args): (expires, table versions, response)
+cache_stats = {} # name: [hits, misses]
+cache_lock = Lock()
+
+def call(command, message, args):
+  if not command.cache_ttl:
+    return command.func(message, **args)
+
+  key = (command.name, tuple(sorted(args.items()))) # The exact args, since responses may echo them back (e.g. the username in !pb)
+  versions = database.get_table_versions(command.cache_tables) # Read before running the command, so that concurrent writes invalidate the response
+  if command.cache_rows:
+    versions += database.get_row_versions(command.cache_rows(**args))
+  now = seconds_since_epoch()
+  with cache_lock:
+    stats = cache_stats.setdefault(command.name, [0, 0])
+    entry = response_cache.get(key)
+    if entry and entry[0] > now and entry[1] == versions:
+      stats[0] += 1
+      metrics.cache_requests.inc(cache='responses', result='hit')
+      return entry[2]
+    stats[1] += 1
+  metrics.cache_requests.inc(cache='responses', result='miss')
+
+  response = command.func(message, **args) # Errors are not cached
+  with cache_lock:
+    response_cache[key] = (now + command.cache_ttl, versions, response)
+    # Expired entries are only replaced when the same args are used again, so occasionally sweep them all.
+    if len(response_cache) > 1000:
+      for key in [key for key, entry in response_cache.items() if entry[0] <= now]:
+        del response_cache[key]
+  return response
+
+
+def get_cache_stats():
+  with cache_lock:
+    output = f'{len(response_cache)} cached responses\n'
+    for name, (hits, misses) in sorted(cache_stats.items()):
+      output += f'!{name}: {hits} hits, {misses} misses ({100 * hits / (hits + misses):.0f}% hit rate)\n'
+    return output
+
+
+# Converts a command into the JSON that discord expects when registering a slash command.
+# https://discord.com/developers/docs/interactions/application-commands#application-command-object
+def to_slash_command(command):
+  options = []
+  for spec in command.args:
+    options.append({
+      'name': spec.name,
+      'description': spec.description,
+      'type': 7 if spec.kind == CHANNEL else 3, # CHANNEL or STRING
+      'required': spec.required and spec.kind != CHANNEL, # Channels default to the current channel
+    })
+  options.sort(key=lambda option: not option['required']) # Discord requires that required options come first
+
+  slash_command = {
+    'type': 1, # CHAT_INPUT
+    'name': command.name,
+    'description': command.description[:100],
+    'options': options,
   }
-"""
+  if command.admin:
+    slash_command['default_member_permissions'] = '0' # Hidden from everyone except server admins. We still check the admin list when it's used.
+  return slash_command
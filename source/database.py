@@ -1,299 +1,516 @@
-import logging
-import sqlite3
-from pathlib import Path
-from threading import Lock
-
-from . import exceptions
-from .utils import seconds_since_epoch
-
-conn = sqlite3.connect(
-  database = Path(__file__).with_name('database.db'),
-  isolation_level = None, # Automatically commit after making a statement
-  check_same_thread = False,
-)
-lock = Lock()
-c = conn.cursor()
-c.execute('''CREATE TABLE IF NOT EXISTS users (
-  twitch_username  TEXT    NOT NULL    PRIMARY KEY,
-  src_id           TEXT                UNIQUE,
-  last_fetched     REAL
-)''')
-c.execute('''CREATE TABLE IF NOT EXISTS tracked_games (
-  game_name        TEXT    NOT NULL    PRIMARY KEY,
-  twitch_game_id   TEXT    NOT NULL    UNIQUE,
-  src_game_id      TEXT    NOT NULL    UNIQUE,
-  discord_channel  INTEGER NOT NULL
-)''')
-c.execute('''CREATE TABLE IF NOT EXISTS src_game_series (
-  src_game_id      TEXT    NOT NULL    PRIMARY KEY,
-  src_series_id    TEXT    NOT NULL,
-  last_fetched     REAL
-)''')
-c.execute('''CREATE TABLE IF NOT EXISTS personal_bests (
-  src_id           TEXT    NOT NULL,
-  src_game_id      TEXT    NOT NULL,
-  FOREIGN KEY (src_id)      REFERENCES users (src_id),
-  FOREIGN KEY (src_game_id) REFERENCES tracked_games (src_game_id),
-  PRIMARY KEY (src_id, src_game_id)
-)''')
-c.execute('''CREATE TABLE IF NOT EXISTS moderated_games (
-  game_name        TEXT    NOT NULL    PRIMARY KEY,
-  src_game_id      TEXT    NOT NULL    UNIQUE,
-  discord_channel  INTEGER NOT NULL,
-  last_update      REAL
-)''')
-c.execute('''CREATE TABLE IF NOT EXISTS announced_streams (
-  name             TEXT    NOT NULL,
-  game             TEXT    NOT NULL,
-  title            TEXT    NOT NULL,
-  url              TEXT    NOT NULL,
-  preview          TEXT    NOT NULL,
-  channel_id       INTEGER NOT NULL,
-  message_id       INTEGER NOT NULL,
-  start            REAL    NOT NULL,
-  preview_expires  REAL    NOT NULL,
-  PRIMARY KEY (name, game)
-)''')
-c.execute('''CREATE TABLE IF NOT EXISTS unverified_runs (
-  run_id           TEXT    NOT NULL     PRIMARY KEY,
-  src_game_id      TEXT    NOT NULL,
-  submitted        REAL    NOT NULL,
-  channel_id       INTEGER NOT NULL,
-  message_id       INTEGER NOT NULL
-)''')
-
-
-# Simple helper to pack *args (because SQL wants it like that)
-def execute(sql, *args):
-  with lock:
-    return c.execute(sql, args)
-
-
-def fetchone():
-  with lock:
-    return c.fetchone()
-
-
-def fetchall():
-  with lock:
-    return c.fetchall()
-
-
-# Commands related to users
-def add_user(twitch_username, src_id, fetch_time=None):
-  if fetch_time is None:
-    fetch_time = seconds_since_epoch()
-  execute('INSERT OR REPLACE INTO users VALUES (?, ?, ?)', twitch_username.lower(), src_id, fetch_time)
-
-
-def get_user(twitch_username):
-  execute('SELECT * FROM users WHERE twitch_username=?', twitch_username.lower())
-  if data := fetchone():
-    return {
-      'twitch_username': data[0],
-      'src_id': data[1],
-      'fetch_time': data[2],
-    }
-  return None
-
-
-def remove_user(twitch_username):
-  src_id = get_user(twitch_username)['src_id']
-  execute('DELETE FROM personal_bests WHERE src_id=?', src_id)
-  execute('DELETE FROM users WHERE twitch_username=?', twitch_username)
-
-
-def update_user_fetch_time(twitch_username, last_fetched=None):
-  if not last_fetched:
-    last_fetched = seconds_since_epoch()
-  execute('UPDATE users SET last_fetched=? WHERE twitch_username=?', last_fetched, twitch_username.lower())
-  conn.commit()
-
-
-# Commands related to tracked_games
-def add_game(game_name, twitch_game_id, src_game_id, discord_channel):
-  try:
-    execute('INSERT INTO tracked_games VALUES (?, ?, ?, ?)', game_name, twitch_game_id, src_game_id, int(discord_channel))
-  except sqlite3.IntegrityError:
-    logging.exception('SQL error')
-    raise exceptions.CommandError(f'Game `{game_name}` is already being tracked.')
-
-
-def get_all_games():
-  execute('SELECT game_name, twitch_game_id, src_game_id FROM tracked_games')
-  return fetchall()
-
-
-def get_channel_for_game(twitch_game_id):
-  execute('SELECT discord_channel FROM tracked_games WHERE twitch_game_id=?', twitch_game_id)
-  if data := fetchone():
-    return data[0]
-  return None
-
-
-def get_games_for_channel(channel_id):
-  execute('SELECT game_name, src_game_id, twitch_game_id FROM tracked_games WHERE discord_channel=?', channel_id)
-  return [{
-    'game_name': d[0],
-    'src_game_id': d[1],
-    'twitch_game_id': d[2],
-  } for d in fetchall()]
-
-
-def remove_game(game_name):
-  execute('SELECT src_game_id FROM tracked_games WHERE game_name=?', game_name)
-  src_game_id = fetchone()
-  if src_game_id is None:
-    raise exceptions.CommandError(f'Cannot remove `{game_name}` as it is not currently being tracked.')
-
-  # Note: There is no need to delete users here -- users are cross-game.
-  execute('DELETE FROM personal_bests WHERE src_game_id=?', src_game_id[0])
-  execute('DELETE FROM tracked_games WHERE src_game_id=?', src_game_id[0])
-
-
-# Commands related to src_game_series
-def set_game_series(src_game_id, series_id):
-  fetch_time = seconds_since_epoch()
-  execute('INSERT OR REPLACE INTO src_game_series VALUES (?, ?, ?)', src_game_id, series_id, fetch_time)
-
-
-def get_game_series(src_game_id):
-  execute('SELECT src_series_id, last_fetched FROM src_game_series WHERE src_game_id=?', src_game_id)
-  if data := fetchone():
-    return data
-  return None, None
-
-
-def get_games_in_series(src_series_id):
-  execute('SELECT src_game_id FROM src_game_series WHERE src_series_id=?', src_series_id)
-  return [d[0] for d in fetchall()]
-
-
-# Commands related to personal_bests
-def add_personal_best(src_id, src_game_id):
-  try:
-    execute('INSERT INTO personal_bests VALUES (?, ?)', src_id, src_game_id)
-  except sqlite3.IntegrityError:
-    logging.exception('SQL error')
-    logging.info(f'Speedrun.com user `{src_id}` already had a PB in game ID `{src_game_id}`.')
-    # But this isn't actually a problem, so we return without throwing an exception
-
-
-def has_personal_best(src_id, src_game_id):
-  execute('SELECT * FROM personal_bests WHERE src_id=? AND src_game_id=?', src_id, src_game_id)
-  return fetchone() != None
-
-
-# Commands related to moderated_games
-def moderate_game(game_name, src_game_id, discord_channel):
-  try:
-    execute('INSERT INTO moderated_games VALUES (?, ?, ?, 0)', game_name, src_game_id, int(discord_channel))
-  except sqlite3.IntegrityError:
-    logging.exception('SQL error')
-    raise exceptions.CommandError(f'Game `{game_name}` is already being moderated.')
-
-
-def get_all_moderated_games():
-  execute('SELECT game_name, src_game_id, discord_channel FROM moderated_games')
-  return fetchall()
-
-
-def unmoderate_game(game_name):
-  execute('SELECT src_game_id FROM moderated_games WHERE game_name=?', game_name)
-  src_game_id = fetchone()[0]
-  print(src_game_id)
-  execute('DELETE FROM unverified_runs WHERE src_game_id=?', src_game_id)
-  execute('DELETE FROM moderated_games WHERE src_game_id=?', src_game_id)
-
-
-# Commands related to announced_streams
-def add_announced_stream(**announced_stream):
-  announced_stream['start'] = seconds_since_epoch()
-
-  execute('INSERT INTO announced_streams VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
-    announced_stream['name'],
-    announced_stream['game'],
-    announced_stream['title'],
-    announced_stream['url'],
-    announced_stream['preview'],
-    announced_stream['channel_id'],
-    announced_stream['message_id'],
-    announced_stream['start'],
-    announced_stream['preview_expires'],
-  )
-
-
-def update_announced_stream(announced_stream):
-  execute('''
-      UPDATE announced_streams
-      SET title=?, preview_expires=?
-      WHERE name=? AND game=?''',
-    announced_stream['title'],
-    announced_stream['preview_expires'],
-    announced_stream['name'],
-    announced_stream['game'],
-  )
-
-
-def get_announced_streams():
-  execute('SELECT * FROM announced_streams')
-  for data in fetchall():
-    yield {
-      'name': data[0],
-      'game': data[1],
-      'title': data[2],
-      'url': data[3],
-      'preview': data[4],
-      'channel_id': data[5],
-      'message_id': data[6],
-      'start': data[7],
-      'preview_expires': data[8],
-    }
-
-
-def get_announced_stream(name, game):
-  execute('SELECT * FROM announced_streams WHERE name=? AND game=?', name, game)
-  if data := fetchone():
-    return {
-      'name': data[0],
-      'game': data[1],
-      'title': data[2],
-      'url': data[3],
-      'preview': data[4],
-      'channel_id': data[5],
-      'message_id': data[6],
-      'start': data[7],
-      'preview_expires': data[8],
-    }
-  return None
-
-
-def delete_announced_stream(announced_stream):
-  execute('DELETE FROM announced_streams WHERE name=? AND game=?', announced_stream['name'], announced_stream['game'])
-
-
-# Commands related to unverified_runs
-def get_unverified_runs(src_game_id):
-  execute('SELECT * FROM unverified_runs WHERE src_game_id=?', src_game_id)
-  return {d[0]: {
-    'run_id': d[0],
-    'src_game_id': d[1],
-    'submitted': d[2],
-    'channel_id': d[3],
-    'message_id': d[4],
-  } for d in fetchall()}
-
-
-def add_unverified_run(**unverified_run):
-  execute('INSERT INTO unverified_runs VALUES (?, ?, ?, ?, ?)',
-    unverified_run['run_id'],
-    unverified_run['src_game_id'],
-    unverified_run['submitted'],
-    unverified_run['channel_id'],
-    unverified_run['message_id'],
-  )
-
-
-def delete_unverified_run(run_id):
-  execute('DELETE FROM unverified_runs WHERE run_id=?', run_id)
-
+import bisect
+import logging
+import os
+import re
+import sqlite3
+import sys
+from pathlib import Path
+from threading import Lock
+from time import perf_counter
+
+from . import exceptions, json_codec, metrics
+from .records import AnnouncedStream, CatalogGame, UnverifiedRun, User
+from .utils import seconds_since_epoch
+
+# The database is saved next to this file, unless SPEEDRUNBOT_DATABASE is set to another path (or to ':memory:', e.g. for benchmarks).
+path = os.environ.get('SPEEDRUNBOT_DATABASE') or Path(__file__).with_name('database.db')
+conn = sqlite3.connect(
+  database = path,
+  isolation_level = None, # Automatically commit after making a statement
+  check_same_thread = False,
+)
+lock = Lock()
+c = conn.cursor()
+c.execute('''CREATE TABLE IF NOT EXISTS users (
+  twitch_username  TEXT    NOT NULL    PRIMARY KEY,
+  src_id           TEXT                UNIQUE,
+  last_fetched     REAL
+)''')
+c.execute('''CREATE TABLE IF NOT EXISTS tracked_games (
+  game_name        TEXT    NOT NULL    PRIMARY KEY,
+  twitch_game_id   TEXT    NOT NULL    UNIQUE,
+  src_game_id      TEXT    NOT NULL    UNIQUE,
+  discord_channel  INTEGER NOT NULL
+)''')
+c.execute('''CREATE TABLE IF NOT EXISTS src_game_series (
+  src_game_id      TEXT    NOT NULL    PRIMARY KEY,
+  src_series_id    TEXT    NOT NULL,
+  last_fetched     REAL
+)''')
+c.execute('''CREATE TABLE IF NOT EXISTS personal_bests (
+  src_id           TEXT    NOT NULL,
+  src_game_id      TEXT    NOT NULL,
+  FOREIGN KEY (src_id)      REFERENCES users (src_id),
+  FOREIGN KEY (src_game_id) REFERENCES tracked_games (src_game_id),
+  PRIMARY KEY (src_id, src_game_id)
+)''')
+c.execute('''CREATE TABLE IF NOT EXISTS moderated_games (
+  game_name        TEXT    NOT NULL    PRIMARY KEY,
+  src_game_id      TEXT    NOT NULL    UNIQUE,
+  discord_channel  INTEGER NOT NULL,
+  last_update      REAL
+)''')
+c.execute('''CREATE TABLE IF NOT EXISTS announced_streams (
+  name             TEXT    NOT NULL,
+  game             TEXT    NOT NULL,
+  title            TEXT    NOT NULL,
+  url              TEXT    NOT NULL,
+  preview          TEXT    NOT NULL,
+  channel_id       INTEGER NOT NULL,
+  message_id       INTEGER NOT NULL,
+  start            REAL    NOT NULL,
+  preview_expires  REAL    NOT NULL,
+  PRIMARY KEY (name, game)
+)''')
+c.execute('''CREATE TABLE IF NOT EXISTS app_tokens (
+  service          TEXT    NOT NULL    PRIMARY KEY,
+  token            TEXT    NOT NULL,
+  expires          REAL    NOT NULL
+)''')
+c.execute('''CREATE TABLE IF NOT EXISTS unverified_runs (
+  run_id           TEXT    NOT NULL     PRIMARY KEY,
+  src_game_id      TEXT    NOT NULL,
+  submitted        REAL    NOT NULL,
+  channel_id       INTEGER NOT NULL,
+  message_id       INTEGER NOT NULL
+)''')
+c.execute('''CREATE TABLE IF NOT EXISTS pb_snapshots (
+  src_id           TEXT    NOT NULL    PRIMARY KEY,
+  src_game_ids     TEXT    NOT NULL,
+  runs             TEXT,
+  last_fetched     REAL    NOT NULL
+)''')
+c.execute('''CREATE TABLE IF NOT EXISTS negative_results (
+  cache            TEXT    NOT NULL,
+  key              TEXT    NOT NULL,
+  tier             INTEGER NOT NULL,
+  expires          REAL    NOT NULL,
+  PRIMARY KEY (cache, key)
+)''')
+c.execute('''CREATE TABLE IF NOT EXISTS game_catalog (
+  src_game_id      TEXT    NOT NULL    PRIMARY KEY,
+  name             TEXT    NOT NULL,
+  aliases          TEXT    NOT NULL,
+  twitch_name      TEXT,
+  twitch_game_id   TEXT,
+  src_series_id    TEXT,
+  last_fetched     REAL    NOT NULL
+)''')
+
+
+# Each table's version is bumped whenever it's written to, so that caches of data derived from the database (e.g. command responses) can tell when they're stale.
+# Writes which only touch one user's (or stream's) rows can pass that row's key, so that caches which depend on a few rows of a busy table
+# aren't invalidated by writes to the others. Writes which don't pass a key may touch any row, so they bump the (table, None) version instead.
+table_versions = {} # table name: version
+row_versions = {} # (table name, row key or None): version
+WRITE_STATEMENT = re.compile(r'(?:INSERT(?: OR \w+)? INTO|UPDATE|DELETE FROM)\s+(\w+)')
+
+db_seconds = metrics.histogram('db_query_seconds', 'Time taken by database queries (including waiting for the lock), by the database function which made them')
+
+# Simple helper to pack *args (because SQL wants it like that)
+def execute(sql, *args, row=None):
+  start = perf_counter()
+  with lock:
+    cursor = c.execute(sql, args)
+    if match := WRITE_STATEMENT.match(sql.lstrip()): # Fails on the first character for SELECTs
+      table_versions[match[1]] = table_versions.get(match[1], 0) + 1
+      row_versions[(match[1], row)] = row_versions.get((match[1], row), 0) + 1
+  db_seconds.observe(perf_counter() - start, function=sys._getframe(1).f_code.co_name)
+  return cursor
+
+
+def get_table_versions(tables):
+  return tuple(table_versions.get(table, 0) for table in tables)
+
+
+def get_row_versions(rows):
+  # rows is a list of (table name, row key)
+  return tuple((row_versions.get((table, None), 0), row_versions.get((table, key), 0)) for table, key in rows)
+
+
+def fetchone():
+  with lock:
+    return c.fetchone()
+
+
+def fetchall():
+  with lock:
+    return c.fetchall()
+
+
+# Cursors which build records straight from rows, rather than building a tuple and then converting it.
+def record_cursor(record_type):
+  cursor = conn.cursor()
+  cursor.row_factory = lambda cursor, row: record_type(*row)
+  return cursor
+announced_streams_cursor = record_cursor(AnnouncedStream)
+game_catalog_cursor = record_cursor(CatalogGame)
+users_cursor = record_cursor(User)
+unverified_runs_cursor = record_cursor(UnverifiedRun)
+
+
+def query(cursor, sql, *args):
+  start = perf_counter()
+  with lock:
+    rows = cursor.execute(sql, args).fetchall()
+  db_seconds.observe(perf_counter() - start, function=sys._getframe(1).f_code.co_name)
+  return rows
+
+
+# Commands related to users
+def add_user(twitch_username, src_id, fetch_time=None):
+  if fetch_time is None:
+    fetch_time = seconds_since_epoch()
+  execute('INSERT OR REPLACE INTO users VALUES (?, ?, ?)', twitch_username.lower(), src_id, fetch_time, row=twitch_username.lower())
+
+
+def get_user(twitch_username):
+  if data := query(users_cursor, 'SELECT * FROM users WHERE twitch_username=?', twitch_username.lower()):
+    return data[0]
+  return None
+
+
+def remove_user(twitch_username):
+  src_id = get_user(twitch_username).src_id
+  execute('DELETE FROM personal_bests WHERE src_id=?', src_id, row=src_id)
+  execute('DELETE FROM pb_snapshots WHERE src_id=?', src_id, row=src_id)
+  execute('DELETE FROM users WHERE twitch_username=?', twitch_username, row=twitch_username.lower())
+
+
+def update_user_fetch_time(twitch_username, last_fetched=None):
+  if not last_fetched:
+    last_fetched = seconds_since_epoch()
+  execute('UPDATE users SET last_fetched=? WHERE twitch_username=?', last_fetched, twitch_username.lower(), row=twitch_username.lower())
+  conn.commit()
+
+
+# Commands related to tracked_games
+def add_game(game_name, twitch_game_id, src_game_id, discord_channel):
+  try:
+    execute('INSERT INTO tracked_games VALUES (?, ?, ?, ?)', game_name, twitch_game_id, src_game_id, int(discord_channel))
+  except sqlite3.IntegrityError:
+    logging.exception('SQL error')
+    raise exceptions.CommandError(f'Game `{game_name}` is already being tracked.')
+
+
+def get_all_games():
+  execute('SELECT game_name, twitch_game_id, src_game_id FROM tracked_games')
+  return fetchall()
+
+
+def get_channel_for_game(twitch_game_id):
+  execute('SELECT discord_channel FROM tracked_games WHERE twitch_game_id=?', twitch_game_id)
+  if data := fetchone():
+    return data[0]
+  return None
+
+
+def get_games_for_channel(channel_id):
+  execute('SELECT game_name, src_game_id, twitch_game_id FROM tracked_games WHERE discord_channel=?', channel_id)
+  return [{
+    'game_name': d[0],
+    'src_game_id': d[1],
+    'twitch_game_id': d[2],
+  } for d in fetchall()]
+
+
+def remove_game(game_name):
+  execute('SELECT src_game_id FROM tracked_games WHERE game_name=?', game_name)
+  src_game_id = fetchone()
+  if src_game_id is None:
+    raise exceptions.CommandError(f'Cannot remove `{game_name}` as it is not currently being tracked.')
+
+  # Note: There is no need to delete users here -- users are cross-game.
+  execute('DELETE FROM personal_bests WHERE src_game_id=?', src_game_id[0])
+  execute('DELETE FROM tracked_games WHERE src_game_id=?', src_game_id[0])
+
+
+def get_runners_of_tracked_games():
+  execute('''
+    SELECT DISTINCT users.twitch_username FROM users
+    JOIN personal_bests ON users.src_id = personal_bests.src_id
+    JOIN tracked_games ON personal_bests.src_game_id = tracked_games.src_game_id''')
+  return [d[0] for d in fetchall()]
+
+
+# Commands related to src_game_series
+def set_game_series(src_game_id, series_id):
+  fetch_time = seconds_since_epoch()
+  execute('INSERT OR REPLACE INTO src_game_series VALUES (?, ?, ?)', src_game_id, series_id, fetch_time)
+
+
+def get_game_series(src_game_id):
+  execute('SELECT src_series_id, last_fetched FROM src_game_series WHERE src_game_id=?', src_game_id)
+  if data := fetchone():
+    return data
+  return None, None
+
+
+def get_games_in_series(src_series_id):
+  execute('SELECT src_game_id FROM src_game_series WHERE src_series_id=?', src_series_id)
+  return [d[0] for d in fetchall()]
+
+
+# Commands related to personal_bests
+def add_personal_best(src_id, src_game_id):
+  try:
+    execute('INSERT INTO personal_bests VALUES (?, ?)', src_id, src_game_id, row=src_id)
+  except sqlite3.IntegrityError:
+    logging.exception('SQL error')
+    logging.info(f'Speedrun.com user `{src_id}` already had a PB in game ID `{src_game_id}`.')
+    # But this isn't actually a problem, so we return without throwing an exception
+
+
+def has_personal_best(src_id, src_game_id):
+  execute('SELECT * FROM personal_bests WHERE src_id=? AND src_game_id=?', src_id, src_game_id)
+  return fetchone() != None
+
+
+# Commands related to pb_snapshots
+# A snapshot is every game which a user has a PB in, from a single fetch of their PBs. The runs themselves (as JSON) are only saved for !pb.
+def set_pb_snapshot(src_id, src_game_ids, runs=None):
+  if runs is not None:
+    runs = json_codec.dumps(runs)
+  execute('INSERT OR REPLACE INTO pb_snapshots VALUES (?, ?, ?, ?)', src_id, '\n'.join(sorted(src_game_ids)), runs, seconds_since_epoch(), row=src_id)
+
+
+def get_pb_snapshot(src_id):
+  # Returns (set of src_game_ids, runs or None, last_fetched), or None if there is no snapshot
+  execute('SELECT src_game_ids, runs, last_fetched FROM pb_snapshots WHERE src_id=?', src_id)
+  if data := fetchone():
+    src_game_ids, runs, last_fetched = data
+    return set(src_game_ids.split('\n')) - {''}, json_codec.loads(runs) if runs else None, last_fetched
+  return None
+
+
+def get_stale_pb_snapshots(fetched_before, limit):
+  execute('SELECT src_id FROM pb_snapshots WHERE last_fetched<? ORDER BY last_fetched LIMIT ?', fetched_before, limit)
+  return [d[0] for d in fetchall()]
+
+
+# Commands related to negative_results (see negative_cache.py)
+def get_negative_result(cache, key):
+  # Returns (tier, expires), or None
+  execute('SELECT tier, expires FROM negative_results WHERE cache=? AND key=?', cache, key)
+  return fetchone()
+
+
+def set_negative_result(cache, key, tier, expires):
+  execute('INSERT OR REPLACE INTO negative_results VALUES (?, ?, ?, ?)', cache, key, tier, expires)
+
+
+def delete_negative_result(cache, key):
+  execute('DELETE FROM negative_results WHERE cache=? AND key=?', cache, key)
+
+
+# Commands related to moderated_games
+def moderate_game(game_name, src_game_id, discord_channel):
+  try:
+    execute('INSERT INTO moderated_games VALUES (?, ?, ?, 0)', game_name, src_game_id, int(discord_channel))
+  except sqlite3.IntegrityError:
+    logging.exception('SQL error')
+    raise exceptions.CommandError(f'Game `{game_name}` is already being moderated.')
+
+
+def get_all_moderated_games():
+  execute('SELECT game_name, src_game_id, discord_channel FROM moderated_games')
+  return fetchall()
+
+
+def unmoderate_game(game_name):
+  execute('SELECT src_game_id FROM moderated_games WHERE game_name=?', game_name)
+  src_game_id = fetchone()[0]
+  print(src_game_id)
+  execute('DELETE FROM unverified_runs WHERE src_game_id=?', src_game_id)
+  execute('DELETE FROM moderated_games WHERE src_game_id=?', src_game_id)
+
+
+# Commands related to announced_streams
+# Announced streams are read on every tick, so we keep an authoritative copy in memory (keyed by name and game),
+# which is loaded once and written through to the database.
+# NOTE: Callers may read the returned streams, but must go through update_announced_stream to change them.
+def load_announced_streams():
+  return {(stream.name, stream.game): stream for stream in query(announced_streams_cursor, 'SELECT * FROM announced_streams')}
+announced_streams = load_announced_streams()
+announced_games = {stream.name.lower(): stream.game for stream in announced_streams.values()} # Lowercase name: game, for commands which take a twitch username
+
+
+def add_announced_stream(**announced_stream):
+  announced_stream = AnnouncedStream(start=seconds_since_epoch(), **announced_stream)
+
+  execute('INSERT INTO announced_streams VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+    announced_stream.name,
+    announced_stream.game,
+    announced_stream.title,
+    announced_stream.url,
+    announced_stream.preview,
+    announced_stream.channel_id,
+    announced_stream.message_id,
+    announced_stream.start,
+    announced_stream.preview_expires,
+    row=announced_stream.name.lower(),
+  )
+  announced_streams[(announced_stream.name, announced_stream.game)] = announced_stream
+  announced_games[announced_stream.name.lower()] = announced_stream.game
+
+
+def update_announced_stream(announced_stream):
+  execute('''
+      UPDATE announced_streams
+      SET title=?, preview_expires=?
+      WHERE name=? AND game=?''',
+    announced_stream.title,
+    announced_stream.preview_expires,
+    announced_stream.name,
+    announced_stream.game,
+    row=announced_stream.name.lower(),
+  )
+  if existing := announced_streams.get((announced_stream.name, announced_stream.game)):
+    existing.title = announced_stream.title
+    existing.preview_expires = announced_stream.preview_expires
+
+
+def get_announced_streams():
+  return list(announced_streams.values())
+
+
+def get_announced_stream(name, game):
+  return announced_streams.get((name, game))
+
+
+def get_announced_game(twitch_username):
+  return announced_games.get(twitch_username.lower())
+
+
+def delete_announced_stream(announced_stream):
+  execute('DELETE FROM announced_streams WHERE name=? AND game=?', announced_stream.name, announced_stream.game, row=announced_stream.name.lower())
+  announced_streams.pop((announced_stream.name, announced_stream.game), None)
+  if announced_games.get(announced_stream.name.lower()) == announced_stream.game:
+    del announced_games[announced_stream.name.lower()]
+
+
+# Commands related to unverified_runs
+def get_unverified_runs(src_game_id):
+  return {run.run_id: run for run in query(unverified_runs_cursor, 'SELECT * FROM unverified_runs WHERE src_game_id=?', src_game_id)}
+
+
+def add_unverified_run(**unverified_run):
+  execute('INSERT INTO unverified_runs VALUES (?, ?, ?, ?, ?)',
+    unverified_run['run_id'],
+    unverified_run['src_game_id'],
+    unverified_run['submitted'],
+    unverified_run['channel_id'],
+    unverified_run['message_id'],
+  )
+
+
+def delete_unverified_run(run_id):
+  execute('DELETE FROM unverified_runs WHERE run_id=?', run_id)
+
+
+
+# Commands related to app_tokens
+def get_app_token(service):
+  execute('SELECT token, expires FROM app_tokens WHERE service=?', service)
+  if data := fetchone():
+    return data
+  return None, 0
+
+
+def set_app_token(service, token, expires):
+  execute('INSERT OR REPLACE INTO app_tokens VALUES (?, ?, ?)', service, token, expires)
+
+
+# Commands related to game_catalog
+# Game names are looked up by every game command, and rarely change, so we keep a catalog of every game we've seen.
+# It's indexed in memory by normalized name & alias (exact lookups), plus a sorted list of those names (prefix lookups, for suggestions).
+def normalize_game_name(name):
+  return ' '.join(name.lower().split())
+
+
+def load_game_catalog():
+  global game_catalog, game_names, sorted_game_names, twitch_game_ids
+  game_catalog = {} # src_game_id: CatalogGame
+  game_names = {} # normalized name or alias: set of src_game_ids
+  sorted_game_names = []
+  twitch_game_ids = {} # normalized twitch name: twitch_game_id
+  for game in query(game_catalog_cursor, 'SELECT * FROM game_catalog'):
+    index_catalog_game(game)
+
+
+def index_catalog_game(game):
+  game_catalog[game.src_game_id] = game
+  for name in [game.name, *game.aliases.split('\n')]:
+    name = normalize_game_name(name)
+    if name not in game_names:
+      game_names[name] = set()
+      bisect.insort(sorted_game_names, name)
+    game_names[name].add(game.src_game_id)
+  if game.twitch_name and game.twitch_game_id:
+    twitch_game_ids[normalize_game_name(game.twitch_name)] = game.twitch_game_id
+
+
+def add_catalog_game(src_game_id, name, aliases, twitch_name, src_series_id):
+  aliases = {alias for alias in aliases if alias}
+  twitch_game_id = None
+  if twitch_name:
+    aliases.add(twitch_name) # Streams only know the twitch name of their game
+    twitch_game_id = twitch_game_ids.get(normalize_game_name(twitch_name))
+  if existing := game_catalog.get(src_game_id):
+    aliases.update(existing.aliases.split('\n'))
+  aliases.discard(name)
+
+  game = CatalogGame(src_game_id, name, '\n'.join(sorted(aliases)), twitch_name, twitch_game_id, src_series_id, seconds_since_epoch())
+  execute('INSERT OR REPLACE INTO game_catalog VALUES (?, ?, ?, ?, ?, ?, ?)',
+    game.src_game_id,
+    game.name,
+    game.aliases,
+    game.twitch_name,
+    game.twitch_game_id,
+    game.src_series_id,
+    game.last_fetched,
+  )
+  index_catalog_game(game)
+  return game
+
+
+def find_catalog_games(game_name):
+  # Games whose name or alias is exactly game_name (ignoring case and spacing), sorted by name.
+  src_game_ids = game_names.get(normalize_game_name(game_name), ())
+  return sorted((game_catalog[src_game_id] for src_game_id in src_game_ids), key=lambda game: game.name)
+
+
+def suggest_catalog_games(prefix, limit=10):
+  # Names of games with a name or alias starting with prefix.
+  prefix = normalize_game_name(prefix)
+  suggestions = []
+  for i in range(bisect.bisect_left(sorted_game_names, prefix), len(sorted_game_names)):
+    if not sorted_game_names[i].startswith(prefix):
+      break
+    for src_game_id in sorted(game_names[sorted_game_names[i]]):
+      name = game_catalog[src_game_id].name
+      if name not in suggestions:
+        suggestions.append(name)
+    if len(suggestions) >= limit:
+      break
+  return suggestions[:limit]
+
+
+def get_twitch_game_id(twitch_name):
+  return twitch_game_ids.get(normalize_game_name(twitch_name))
+
+
+def set_twitch_game_id(twitch_name, twitch_game_id):
+  execute('UPDATE game_catalog SET twitch_game_id=? WHERE twitch_name=?', twitch_game_id, twitch_name)
+  twitch_game_ids[normalize_game_name(twitch_name)] = twitch_game_id
+  for game in game_catalog.values():
+    if game.twitch_name == twitch_name:
+      game.twitch_game_id = twitch_game_id
+
+
+def clear_game_catalog():
+  execute('DELETE FROM game_catalog')
+  load_game_catalog()
+
+
+load_game_catalog()
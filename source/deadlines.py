@@ -0,0 +1,95 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import Lock
+from time import monotonic
+
+from . import exceptions, metrics
+
+# Each scheduled job runs within a budget: a deadline, and a maximum number of HTTP requests. make_request uses the budget for
+# timeouts and for deciding whether a retry is worth waiting for, and fails once the budget is spent. Callers can check has_room
+# to defer optional work (e.g. revalidating non-runners) to the next tick, rather than delaying announcements.
+# The budget is stored in a context variable, so it follows the job onto worker threads as long as the work is submitted with
+# the caller's context (see make_request.run_async).
+
+deferred_work = metrics.counter('deferred_work_total', 'Optional work which was deferred to the next tick because the budget was low, by job and kind of work')
+
+class Budget():
+  def __init__(self, name, seconds, max_requests=None):
+    self.name = name
+    self.seconds = seconds
+    self.deadline = monotonic() + seconds
+    self.max_requests = max_requests
+    self.requests = 0
+    self.deferred = 0
+    self.lock = Lock() # Shared by all threads working on the job
+
+  def remaining(self):
+    return self.deadline - monotonic()
+
+  def spend(self, description):
+    with self.lock:
+      if self.remaining() <= 0:
+        raise exceptions.DeadlineExceeded(f'{self.name} ran out of time ({self.seconds} seconds) before {description}')
+      if self.max_requests is not None and self.requests >= self.max_requests:
+        raise exceptions.DeadlineExceeded(f'{self.name} ran out of requests ({self.max_requests}) before {description}')
+      self.requests += 1
+
+  def has_room(self, reserve):
+    # Whether more than this fraction of the budget (both time and requests) is left
+    if self.remaining() <= self.seconds * reserve:
+      return False
+    return self.max_requests is None or self.max_requests - self.requests > self.max_requests * reserve
+
+  def stats(self):
+    output = f'{self.name} made {self.requests}'
+    if self.max_requests is not None:
+      output += f'/{self.max_requests}'
+    output += f' requests in {self.seconds - self.remaining():.1f}/{self.seconds} seconds'
+    if self.deferred:
+      output += f', deferring {self.deferred} optional lookups'
+    return output
+
+
+current = ContextVar('budget', default=None)
+
+@contextmanager
+def budget(name, seconds, max_requests=None):
+  token = current.set(Budget(name, seconds, max_requests))
+  try:
+    yield current.get()
+  finally:
+    current.reset(token)
+
+
+def remaining():
+  # Seconds until the current deadline, or None if there is no budget
+  if current_budget := current.get():
+    return max(0, current_budget.remaining())
+  return None
+
+
+def can_wait(seconds):
+  # Whether we can afford to wait this long (e.g. before a retry), and still have time left to make the request
+  current_budget = current.get()
+  return not current_budget or current_budget.remaining() > seconds
+
+
+def cap(seconds):
+  # Limit a wait to the time left before the deadline
+  if (time_left := remaining()) is not None:
+    return min(seconds, time_left)
+  return seconds
+
+
+def has_room(work, reserve=0.5):
+  """
+  Call before optional work (named by work) which makes network calls. Returns False if less than the reserve fraction of
+  the current budget is left, in which case the work should be skipped until the next tick. Always True outside of a budget.
+  """
+  current_budget = current.get()
+  if not current_budget or current_budget.has_room(reserve):
+    return True
+  with current_budget.lock:
+    current_budget.deferred += 1
+  deferred_work.inc(job=current_budget.name, work=work)
+  return False
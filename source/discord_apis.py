@@ -2,15 +2,15 @@ import logging
 import re
 from pathlib import Path
 
-from .make_request import make_request
+from .make_request import make_request, run_async
 from . import exceptions
 
 api = 'https://discord.com/api/v9'
 
 cached_headers = None
-def get_headers():
+def get_headers(refresh=False):
   global cached_headers
-  if not cached_headers:
+  if refresh or not cached_headers: # Re-reading the token on refresh allows the user to update their token without restarting the bot.
     with Path(__file__).with_name('discord_token.txt').open() as f:
       token = f.read().strip()
 
@@ -49,7 +49,7 @@ def REPL(match):
 def escape_markdown(orig_text):
   text = FIND.sub(REPL, orig_text)
   if text != orig_text:
-    logging.info(f'Escaped markdown "{orig_text.encode("utf-8")}" to "{text.encode("utf-8")}"')
+    logging.debug('Escaped markdown %a to %a', orig_text, text)
   return text
 
 
@@ -74,6 +74,13 @@ def send_message_ids(channel_id, content, embed=None):
   return make_request('POST', f'{api}/channels/{channel_id}/messages', json=json, get_headers=get_headers)
 
 
+dm_channels = {} # user id: DM channel id
+def send_direct_message(user_id, content):
+  if user_id not in dm_channels:
+    dm_channels[user_id] = make_request('POST', f'{api}/users/@me/channels', json={'recipient_id': user_id}, get_headers=get_headers)['id']
+  return send_message_ids(dm_channels[user_id], content)
+
+
 def edit_message(message, content=None, embed=None):
   return edit_message_ids(message['channel_id'], message['id'], content=content, embed=embed)
 
@@ -121,9 +128,16 @@ def remove_reaction(message, emoji):
     logging.exception('Error while attempting to add a reaction')
 
 
+cached_application = None
+def get_application():
+  global cached_application
+  if not cached_application:
+    cached_application = make_request('GET', f'{api}/oauth2/applications/@me', get_headers=get_headers)
+  return cached_application
+
+
 def get_owner():
-  j = make_request('GET', f'{api}/oauth2/applications/@me', get_headers=get_headers)
-  return j['owner']
+  return get_application()['owner']
 
 
 def get_servers():
@@ -131,30 +145,66 @@ def get_servers():
   return j
 
 
-def register_slash_command(name, desc, args=None, *, guild=None):
-  options = []
-  if args:
-    for arg_name, arg_desc in args.items():
-      option_type = {'channel': 7}.get(arg_name, 3)
-
-      options.append({
-        'name': arg_name,
-        'description': arg_desc,
-        'type': option_type,
-        'required': True,
-      })
-
-  body = {
-    'type': 1, # CHAT_INPUT
-    'name': name,
-    'description': desc,
-    'options': options
-  }
-
+def register_slash_commands(commands, *, guild=None):
+  """
+  Replace all of this bot's slash commands (globally, or in a single guild) with the given list. Since this is an overwrite, it is safe to call on every startup.
+  See https://discord.com/developers/docs/interactions/application-commands#bulk-overwrite-global-application-commands
+  """
+  app_id = get_application()['id']
   if not guild:
-    url = f'{api}/{app_id}/commands'
+    url = f'{api}/applications/{app_id}/commands'
   else:
-    url += f'{api}/{app_id}/guilds/{guild}/commands'
+    url = f'{api}/applications/{app_id}/guilds/{guild}/commands'
+
+  return make_request('PUT', url, json=commands, get_headers=get_headers)
+
+
+# Interactions must be acknowledged within 3 seconds, so we immediately send a deferred response (which shows "Bot is thinking...")
+# and then edit in the real response once the command finishes. Interaction tokens are valid for 15 minutes.
+# https://discord.com/developers/docs/interactions/receiving-and-responding#responding-to-an-interaction
+def defer_interaction(interaction):
+  body = {'type': 5} # DEFERRED_CHANNEL_MESSAGE_WITH_SOURCE
+  make_request('POST', f'{api}/interactions/{interaction["id"]}/{interaction["token"]}/callback', json=body, get_headers=get_headers)
+
+
+def edit_interaction_response(interaction, content):
+  url = f'{api}/webhooks/{interaction["application_id"]}/{interaction["token"]}/messages/@original'
+  make_request('PATCH', url, json={'content': content}, get_headers=get_headers)
+
+
+# Awaitable versions of the above, for use from the gateway's event loop.
+# These look up the sync function at call time, so they share the same HTTP session (and test patches).
+async def send_message_ids_async(channel_id, content, embed=None):
+  return await run_async(send_message_ids, channel_id, content, embed)
+
+
+async def edit_message_ids_async(channel_id, message_id, content=None, embed=None):
+  return await run_async(edit_message_ids, channel_id, message_id, content=content, embed=embed)
+
+
+async def add_reaction_async(message, emoji):
+  return await run_async(add_reaction, message, emoji)
+
+
+async def add_reaction_ids_async(channel_id, message_id, emoji):
+  return await run_async(add_reaction_ids, channel_id, message_id, emoji)
+
+
+async def remove_reaction_async(message, emoji):
+  return await run_async(remove_reaction, message, emoji)
+
+
+async def get_owner_async():
+  return await run_async(get_owner)
+
+
+async def get_servers_async():
+  return await run_async(get_servers)
+
+
+async def defer_interaction_async(interaction):
+  return await run_async(defer_interaction, interaction)
 
-  make_request('POST', url, json=body, get_headers=get_headers)
 
+async def edit_interaction_response_async(interaction, content):
+  return await run_async(edit_interaction_response, interaction, content)
@@ -0,0 +1,156 @@
+import hashlib
+import hmac
+import logging
+from collections import deque
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from threading import Lock, Thread
+
+from . import database, json_codec, twitch_apis
+from .utils import seconds_since_epoch
+
+# Twitch EventSub, via webhooks. Twitch POSTs to our (public) callback URL whenever a subscribed stream changes.
+# https://dev.twitch.tv/docs/eventsub/handling-webhook-events
+SUBSCRIPTION_TYPES = {
+  'stream.online': '1',
+  'stream.offline': '1',
+  'channel.update': '2', # Title or game change
+}
+MAX_MESSAGE_AGE = 10 * 60 # Twitch recommends rejecting messages older than 10 minutes, to prevent replay attacks.
+
+def get_config():
+  """
+  twitch_eventsub.txt should contain (one per line):
+  - The public https URL which forwards to this bot, e.g. https://example.com/eventsub
+  - A secret (10-100 characters), used to sign messages
+  - (Optional) The local port to listen on, default 8080
+  Returns None if the file does not exist, in which case EventSub is disabled.
+  """
+  path = Path(__file__).with_name('twitch_eventsub.txt')
+  if not path.exists():
+    return None
+  with path.open() as f:
+    lines = [line.strip() for line in f.read().split('\n') if line.strip()]
+  return {
+    'callback': lines[0],
+    'secret': lines[1],
+    'port': int(lines[2]) if len(lines) > 2 else 8080,
+  }
+
+
+def sign(secret, message_id, timestamp, body):
+  message = message_id.encode('utf-8') + timestamp.encode('utf-8') + body
+  return 'sha256=' + hmac.new(secret.encode('utf-8'), message, hashlib.sha256).hexdigest()
+
+
+class Receiver():
+  def __init__(self, secret, on_event, host='127.0.0.1', port=8080):
+    self.secret = secret
+    self.on_event = on_event # Called with (subscription type, event data), on the server's thread.
+    self.seen_message_ids = deque(maxlen=1000) # Twitch may resend messages, these should only be handled once.
+    self.lock = Lock()
+
+    receiver = self
+    class Handler(BaseHTTPRequestHandler):
+      def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        status, response = receiver.handle(self.headers, body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+      def log_message(self, format, *args):
+        logging.info('EventSub: ' + format % args)
+
+    self.server = ThreadingHTTPServer((host, port), Handler)
+    self.port = self.server.server_address[1] # In case port was 0
+
+
+  def start(self):
+    Thread(target=self.server.serve_forever, daemon=True).start()
+    logging.info(f'Listening for EventSub messages on port {self.port}')
+
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
+
+
+  def handle(self, headers, body):
+    message_id = headers.get('Twitch-Eventsub-Message-Id', '')
+    timestamp = headers.get('Twitch-Eventsub-Message-Timestamp', '')
+    signature = headers.get('Twitch-Eventsub-Message-Signature', '')
+    if not hmac.compare_digest(sign(self.secret, message_id, timestamp, body), signature):
+      logging.error(f'Rejecting EventSub message {message_id} with an invalid signature')
+      return 403, b''
+
+    try:
+      # Twitch sends nanosecond precision, which strptime can't parse.
+      sent = datetime.strptime(timestamp[:19], '%Y-%m-%dT%H:%M:%S').replace(tzinfo=timezone.utc)
+    except ValueError:
+      return 400, b''
+    if seconds_since_epoch() - sent.timestamp() > MAX_MESSAGE_AGE:
+      logging.error(f'Rejecting EventSub message {message_id} which was sent at {timestamp}')
+      return 403, b''
+
+    with self.lock:
+      if message_id in self.seen_message_ids:
+        return 204, b'' # Already handled, but we still need to ack it.
+
+    j = json_codec.loads(body)
+    message_type = headers.get('Twitch-Eventsub-Message-Type')
+    subscription_type = j['subscription']['type']
+    if message_type == 'webhook_callback_verification':
+      logging.info(f'Verified EventSub subscription for {subscription_type}')
+      self.mark_handled(message_id)
+      return 200, j['challenge'].encode('utf-8')
+    elif message_type == 'revocation':
+      logging.error(f'EventSub subscription {subscription_type} was revoked: {j["subscription"]["status"]}')
+      self.mark_handled(message_id)
+      return 204, b''
+    elif message_type == 'notification':
+      logging.info(f'Got EventSub notification {subscription_type} for {j["event"].get("broadcaster_user_login")}')
+      try:
+        self.on_event(subscription_type, j['event'])
+      except Exception:
+        logging.exception(f'Failed to handle EventSub message {message_id}, Twitch will resend it')
+        return 500, b'' # Not marked as handled, so that the retry is handled
+      self.mark_handled(message_id)
+      return 204, b''
+
+    logging.error(f'Cannot handle EventSub message type {message_type}')
+    return 400, b''
+
+
+  def mark_handled(self, message_id):
+    # Only once the message has been handled, since Twitch resends messages which we fail to handle.
+    with self.lock:
+      self.seen_message_ids.append(message_id)
+
+
+def sync_subscriptions(callback, secret):
+  """
+  Subscribe to online/offline/update events for every known runner of a tracked game, and unsubscribe from everyone else
+  (e.g. runners of games which are no longer tracked), since Twitch limits how many subscriptions we can have.
+  New runners are not subscribed until they are first found by polling, which is why polling is kept as a fallback.
+  """
+  existing = {} # (subscription type, broadcaster user ID): subscription ID
+  for subscription in twitch_apis.get_eventsub_subscriptions():
+    if subscription['status'] in ['enabled', 'webhook_callback_verification_pending'] and subscription['transport'].get('callback') == callback:
+      existing[(subscription['type'], subscription['condition'].get('broadcaster_user_id'))] = subscription['id']
+
+  wanted = set()
+  usernames = database.get_runners_of_tracked_games()
+  for user_id in twitch_apis.get_user_ids(usernames).values():
+    for subscription_type, version in SUBSCRIPTION_TYPES.items():
+      wanted.add((subscription_type, user_id))
+      if (subscription_type, user_id) not in existing:
+        twitch_apis.create_eventsub_subscription(subscription_type, version, user_id, callback, secret)
+
+  for key, subscription_id in existing.items():
+    if key not in wanted:
+      logging.info('Removing EventSub subscription %s for %s, which is no longer tracked', *key)
+      twitch_apis.delete_eventsub_subscription(subscription_id)
@@ -4,6 +4,14 @@
 class NetworkError(Exception):
   pass
 
+# Raised by make_request when the current job's budget (see deadlines.py) is spent
+class DeadlineExceeded(NetworkError):
+  pass
+
+# Raised by make_request when the host has been failing, without sending the request (see circuit_breakers.py)
+class CircuitOpen(NetworkError):
+  pass
+
 class NetworkError404(Exception):
   pass
 
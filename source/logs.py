@@ -0,0 +1,111 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+from collections import deque
+from datetime import datetime
+
+# Logging is done in two halves: callers only put records onto a queue, and a single background thread formats them and writes them out.
+# That way, (for example) network threads never wait on the log file's lock or on disk I/O.
+# Messages should use %-style args (logging.info('Found %d streams', count)) rather than f-strings, so that they're only formatted
+# if the level is enabled, and then on the logging thread. Since that happens later, args should not be mutated after logging them.
+
+def capture_exception(record):
+  # Tracebacks reference live stack frames, so they are formatted right away (this is rare).
+  if record.exc_info:
+    record.exc_text = logging.Formatter().formatException(record.exc_info)
+    record.exc_info = None
+  return record
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+  def prepare(self, record):
+    # Unlike the default QueueHandler, this does not format the message on the calling thread.
+    return capture_exception(record)
+
+
+class Formatter(logging.Formatter):
+  # https://stackoverflow.com/a/6692653
+  def format(self, r):
+    current_time = datetime.fromtimestamp(r.created).strftime('%Y-%m-%d %H:%M:%S.%f') # Not 'now', since records are formatted some time after they're logged
+    location = f'{r.module}.{r.funcName}:{r.lineno}'
+    message = f'[{current_time}] {r.thread:05} {location:40} {r.getMessage()}'
+
+    if r.exc_info and not r.exc_text:
+      r.exc_text = self.formatException(r.exc_info)
+    if r.exc_text:
+      message += '\n' + r.exc_text
+
+    return message
+
+
+def start_queue_logging(handlers, level=logging.INFO):
+  """
+  Send all logging through a queue to the given handlers, which are run on a background thread. Handler levels are respected.
+  The queue is flushed at exit, or call stop_queue_logging before exiting some other way (e.g. os.kill).
+  """
+  global listener
+  log_queue = queue.SimpleQueue()
+  listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+  listener.start()
+  atexit.register(stop_queue_logging)
+  # The level here acts as a global level filter, so that disabled levels are dropped before they're queued.
+  logging.basicConfig(level=level, handlers=[QueueHandler(log_queue)])
+listener = None
+
+
+def stop_queue_logging():
+  global listener
+  if listener:
+    listener.stop() # Blocks until the queue has been written out
+    listener = None
+
+
+class RingBufferHandler(logging.Handler):
+  """
+  Keeps the last few log records in memory, so that crash reports don't need to re-read the log file.
+  Since this doesn't depend on the file, it keeps working while the log file is being rotated.
+  Records are only formatted when they're read, so this is cheap enough to attach directly (rather than behind the queue), which means it's never behind.
+  """
+  def __init__(self, capacity=500):
+    super().__init__()
+    self.records = deque(maxlen=capacity)
+
+  def emit(self, record):
+    self.records.append(capture_exception(record))
+
+  def get_lines(self):
+    with self.lock: # emit is called while holding this lock, see logging.Handler.handle
+      records = list(self.records)
+    lines = []
+    for record in records:
+      lines += self.format(record).split('\n')
+    return lines[-self.records.maxlen:]
+
+
+class StructuredMessage():
+  __slots__ = ['event', 'fields']
+
+  def __init__(self, event, fields):
+    self.event = event
+    self.fields = fields
+
+  def __str__(self):
+    return self.event + ''.join(f' {key}={value}' for key, value in self.fields.items())
+
+
+class StructuredLogger():
+  """
+  For hot paths (e.g. once per stream or per HTTP request). Logs an event name plus key=value fields, which are easy to grep,
+  and which are only formatted (on the logging thread) if the level is enabled.
+  """
+  def __init__(self, name):
+    self.logger = logging.getLogger(name)
+
+  def debug(self, event, **fields):
+    if self.logger.isEnabledFor(logging.DEBUG):
+      self.logger.debug(StructuredMessage(event, fields), stacklevel=2)
+
+  def info(self, event, **fields):
+    if self.logger.isEnabledFor(logging.INFO):
+      self.logger.info(StructuredMessage(event, fields), stacklevel=2)
@@ -1,77 +1,171 @@
-import logging
-import requests
-from time import sleep
-
-from . import exceptions
-
-backoff = 1
-def success():
-  global backoff
-  backoff = max(1, backoff // 2)
-def failure():
-  global backoff
-  sleep(backoff)
-  backoff = min(60, backoff * 2)
-
-
-def make_request_internal(method, url, *args, retry=True, allow_4xx=False, **kwargs):
-  logging_url = url
-  if method == 'POST': # Strip postdata arguments from the URL since they usually contain secrets.
-    logging_url = url.partition('?')[0]
-
-  if get_headers := kwargs.pop('get_headers', None):
-    kwargs['headers'] = get_headers()
-
-  try:
-    r = requests.request(method, url, *args, **kwargs)
-
-    if retry:
-      if r.status_code in [420, 429]:
-        # Try again exactly once when we are told to back off
-        sleep_time = int(r.headers.get('Retry-After', 5))
-        sleep(sleep_time)
-        r = requests.request(method, url, *args, **kwargs)
-
-      elif r.status_code == 502:
-        # Try again exactly once when we encounter server downtime
-        sleep(5)
-        r = requests.request(method, url, *args, **kwargs)
-
-      elif r.status_code == 401 and get_headers != None:
-        # Try again exactly once with new headers when we get an UNAUTHORIZED error
-        kwargs['headers'] = get_headers()
-        sleep(5)
-        r = requests.request(method, url, *args, **kwargs)
-
-  except requests.exceptions.RequestException as e:
-    failure()
-    raise exceptions.NetworkError(f'{method} {logging_url} failed: {e}')
-
-  if 200 <= r.status_code and r.status_code <= 399:
-    success()
-    logging.info(f'Completed {method} request to {logging_url} with code {r.status_code}')
-    return r
-  elif allow_4xx and 400 <= r.status_code and r.status_code <= 499:
-    failure() # Even if the caller allows client errors, it's still a failure and we should take care not to throttle.
-    logging.info(f'Completed {method} request to {logging_url} with code {r.status_code}')
-    return r
-  elif r.status_code == 404: # TODO: I don't want to silently ignore 404s, but we'll see...
-    failure()
-    raise exceptions.NetworkError404(f'{method} {logging_url} returned {r.status_code} {r.reason.upper()}: {r.text}')
-  else:
-    failure()
-    raise exceptions.NetworkError(f'{method} {logging_url} returned {r.status_code} {r.reason.upper()}: {r.text}')
-
-
-def make_request(method, url, *args, retry=True, **kwargs):
-  r = make_request_internal(method, url, *args, retry=retry, **kwargs)
-
-  if r.status_code == 204: # 204 NO CONTENT
-    return ''
-  return r.json()
-
-
-def make_head_request(url, *args, retry=True, **kwargs):
-  kwargs.setdefault('allow_redirects', False)
-  r = make_request_internal('HEAD', url, *args, retry=retry, **kwargs)
-  return (r.status_code, r.headers)
+import asyncio
+import contextvars
+import logging
+import re
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from time import monotonic, sleep
+from urllib.parse import urlsplit
+
+from . import circuit_breakers, deadlines, exceptions, json_codec, logs, metrics, priorities, timeouts
+
+# All API modules share one session (and thus one connection pool per host), so that we don't redo a TLS handshake for every call.
+session = requests.Session()
+session.mount('https://', timeouts.KeepaliveAdapter(pool_connections=8, pool_maxsize=16))
+session.mount('http://', timeouts.KeepaliveAdapter(pool_connections=8, pool_maxsize=16))
+
+# Blocking calls made from the gateway's event loop are run on this pool, rather than on a new thread per call.
+executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix='http')
+log = logs.StructuredLogger('http') # One line per request
+def run_async(func, *args, **kwargs):
+  # Unlike asyncio.to_thread, run_in_executor does not copy context variables (e.g. the job's budget, see deadlines.py), so do it here.
+  context = contextvars.copy_context()
+  return asyncio.get_running_loop().run_in_executor(executor, partial(context.run, func, *args, **kwargs))
+
+http_seconds = metrics.histogram('http_request_seconds', 'Time taken by HTTP requests (including retries), by host and endpoint')
+http_errors = metrics.counter('http_errors_total', 'HTTP responses which were rate limited (429) or server errors (5xx), and requests which failed to connect (status="failed")')
+
+# IDs, usernames, etc. in URLs are replaced with {id}, so that each endpoint is only one set of metrics.
+# This matches path segments of 4+ characters which contain a digit, which (intentionally) does not match API versions like /v9.
+ID_SEGMENT = re.compile(r'(?<=/)(?=[^/]*\d)[^/]{4,}')
+def get_endpoint(url):
+  parts = urlsplit(url)
+  return parts.netloc, ID_SEGMENT.sub('{id}', parts.path)
+
+
+# Normally None. Set to a callable with the same signature as session.request to record or replay traffic, see recording.py
+transport = None
+
+def request(method, url, *args, **kwargs):
+  host, path = urlsplit(url)[1:3]
+  breaker = circuit_breakers.get(host)
+  probe = breaker.check() # Fails fast while the host is down
+  try:
+    priorities.wait_for_turn(host) # Lower priority requests wait here when the host is busy
+    timeout = kwargs['timeout'] = timeouts.get_timeout(host, path)
+    budget = deadlines.current.get() # Always set, see make_request_internal
+    budget.spend(f'{method} {host}')
+    kwargs['timeout'] = timeouts.cap(timeout, budget.remaining()) # Don't wait on a response past the deadline
+    start = monotonic()
+    with timeouts.watchdog(budget.remaining()) as watchdog: # Nor on a response which arrives a byte at a time
+      try:
+        r = (transport or session.request)(method, url, *args, **kwargs)
+      finally:
+        if watchdog.expired:
+          raise exceptions.DeadlineExceeded(f'{budget.name} ran out of time ({budget.seconds} seconds) while receiving {method} {host}')
+  except requests.exceptions.RequestException as e:
+    if isinstance(e, requests.exceptions.Timeout) and kwargs['timeout'] != timeout:
+      breaker.release(probe) # We gave up early because of the deadline
+    else:
+      breaker.record(False, monotonic() - start, probe)
+    raise
+  except BaseException:
+    breaker.release(probe) # Never sent (e.g. the budget ran out), or cut short by the deadline
+    raise
+  breaker.record(r.status_code < 500, monotonic() - start, probe)
+  if r.status_code == 429 or r.status_code >= 500:
+    http_errors.inc(host=host, status=r.status_code)
+  return r
+
+
+backoff = 1
+def success():
+  global backoff
+  backoff = max(1, backoff // 2)
+def failure():
+  global backoff
+  sleep(deadlines.cap(backoff))
+  backoff = min(60, backoff * 2)
+
+
+def make_request_internal(method, url, *args, **kwargs):
+  if deadlines.current.get():
+    return send_with_retries(method, url, *args, **kwargs)
+
+  # Outside of a job, each call still gets a total deadline, so that retries, backoff and slow responses can't block it for long.
+  host, path = urlsplit(url)[1:3]
+  with deadlines.budget(f'{method} {host}', timeouts.get_deadline(host, path)):
+    return send_with_retries(method, url, *args, **kwargs)
+
+
+def send_with_retries(method, url, *args, retry=True, allow_4xx=False, **kwargs):
+  logging_url = url
+  if method == 'POST': # Strip postdata arguments from the URL since they usually contain secrets.
+    logging_url = url.partition('?')[0]
+
+  if get_headers := kwargs.pop('get_headers', None):
+    kwargs['headers'] = get_headers()
+
+  if 'json' in kwargs: # Encode the body here rather than letting requests do it, so that it uses the faster codec
+    kwargs['data'] = json_codec.dumps_bytes(kwargs.pop('json'))
+    kwargs['headers'] = {'Content-Type': 'application/json', **(kwargs.get('headers') or {})}
+
+  host, endpoint = get_endpoint(url)
+  start = monotonic()
+  try:
+    r = request(method, url, *args, **kwargs)
+
+    if retry:
+      # Retries are skipped if waiting for them would take us past the deadline.
+      if r.status_code in [420, 429]:
+        # Try again exactly once when we are told to back off
+        sleep_time = int(r.headers.get('Retry-After', 5))
+        if deadlines.can_wait(sleep_time):
+          sleep(sleep_time)
+          r = request(method, url, *args, **kwargs)
+
+      elif r.status_code == 502 and deadlines.can_wait(5):
+        # Try again exactly once when we encounter server downtime
+        sleep(5)
+        r = request(method, url, *args, **kwargs)
+
+      elif r.status_code == 401 and get_headers != None and deadlines.can_wait(5):
+        # Try again exactly once with new headers when we get an UNAUTHORIZED error
+        kwargs['headers'] = get_headers(refresh=True)
+        sleep(5)
+        r = request(method, url, *args, **kwargs)
+
+  except requests.exceptions.RequestException as e:
+    http_errors.inc(host=host, status='failed')
+    failure()
+    raise exceptions.NetworkError(f'{method} {logging_url} failed: {e}')
+  finally:
+    http_seconds.observe(monotonic() - start, host=host, endpoint=endpoint)
+
+  if 200 <= r.status_code and r.status_code <= 399:
+    success()
+    log.info('request', method=method, url=logging_url, status=r.status_code, seconds=round(r.elapsed.total_seconds(), 3))
+    return r
+  elif allow_4xx and 400 <= r.status_code and r.status_code <= 499:
+    failure() # Even if the caller allows client errors, it's still a failure and we should take care not to throttle.
+    log.info('request', method=method, url=logging_url, status=r.status_code, seconds=round(r.elapsed.total_seconds(), 3))
+    return r
+  elif r.status_code == 404: # TODO: I don't want to silently ignore 404s, but we'll see...
+    failure()
+    raise exceptions.NetworkError404(f'{method} {logging_url} returned {r.status_code} {r.reason.upper()}: {r.text}')
+  else:
+    failure()
+    raise exceptions.NetworkError(f'{method} {logging_url} returned {r.status_code} {r.reason.upper()}: {r.text}')
+
+
+def make_request(method, url, *args, retry=True, **kwargs):
+  r = make_request_internal(method, url, *args, retry=retry, **kwargs)
+
+  if r.status_code == 204: # 204 NO CONTENT
+    return ''
+  return json_codec.loads(r.content)
+
+
+def make_head_request(url, *args, retry=True, **kwargs):
+  kwargs.setdefault('allow_redirects', False)
+  r = make_request_internal('HEAD', url, *args, retry=retry, **kwargs)
+  return (r.status_code, r.headers)
+
+
+async def make_request_async(method, url, *args, retry=True, **kwargs):
+  return await run_async(make_request, method, url, *args, retry=retry, **kwargs)
+
+
+async def make_head_request_async(url, *args, retry=True, **kwargs):
+  return await run_async(make_head_request, url, *args, retry=retry, **kwargs)
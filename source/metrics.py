@@ -0,0 +1,164 @@
+import bisect
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+
+# A small, in-process metrics registry. Metrics are exposed in the Prometheus text format on a local HTTP endpoint (see serve),
+# and summarized by the !stats command. Each metric has a set of labels (e.g. host), and keeps a separate value per combination of labels.
+# https://prometheus.io/docs/instrumenting/exposition_formats/#text-based-format
+
+registry = {} # name: metric
+registry_lock = Lock()
+
+def label_key(labels):
+  return tuple(sorted(labels.items()))
+
+
+def format_labels(key):
+  if not key:
+    return ''
+  return '{' + ','.join(f'{name}="{value}"' for name, value in key) + '}'
+
+
+class Counter():
+  type = 'counter'
+
+  def __init__(self, name, description):
+    self.name = name
+    self.description = description
+    self.values = {} # label key: value
+    self.lock = Lock()
+
+  def inc(self, amount=1, **labels):
+    key = label_key(labels)
+    with self.lock:
+      self.values[key] = self.values.get(key, 0) + amount
+
+  def get(self, **labels):
+    return self.values.get(label_key(labels), 0)
+
+  def samples(self):
+    with self.lock:
+      return [(self.name, key, value) for key, value in self.values.items()]
+
+  def summary(self):
+    with self.lock:
+      return [f'{format_labels(key)} {value}' for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+  type = 'gauge'
+
+  def set(self, value, **labels):
+    key = label_key(labels)
+    with self.lock:
+      self.values[key] = value
+
+
+# Bucket boundaries (in seconds) for latencies, from 1ms to 1 minute.
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+class Histogram():
+  type = 'histogram'
+
+  def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+    self.name = name
+    self.description = description
+    self.buckets = buckets
+    self.values = {} # label key: [count per bucket (plus one for +Inf), sum, max]
+    self.lock = Lock()
+
+  def observe(self, value, **labels):
+    key = label_key(labels)
+    with self.lock:
+      entry = self.values.get(key)
+      if not entry:
+        entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0, 0]
+      entry[0][bisect.bisect_left(self.buckets, value)] += 1 # Buckets are inclusive of their upper bound
+      entry[1] += value
+      entry[2] = max(entry[2], value)
+
+  def samples(self):
+    samples = []
+    with self.lock:
+      for key, (counts, total, _) in self.values.items():
+        cumulative = 0
+        for bucket, count in zip(self.buckets + ['+Inf'], counts):
+          cumulative += count
+          samples.append((self.name + '_bucket', key + (('le', bucket),), cumulative))
+        samples.append((self.name + '_sum', key, total))
+        samples.append((self.name + '_count', key, cumulative))
+    return samples
+
+  def summary(self):
+    with self.lock:
+      return [f'{format_labels(key)} count={sum(counts)} avg={total / sum(counts):.3f} max={maximum:.3f}' for key, (counts, total, maximum) in self.values.items()]
+
+
+def get_metric(metric_type, name, description, **kwargs):
+  # Metrics are created on first use, and shared by name.
+  with registry_lock:
+    if name not in registry:
+      registry[name] = metric_type(name, description, **kwargs)
+    return registry[name]
+
+
+def counter(name, description):
+  return get_metric(Counter, name, description)
+
+
+def gauge(name, description):
+  return get_metric(Gauge, name, description)
+
+
+def histogram(name, description, **kwargs):
+  return get_metric(Histogram, name, description, **kwargs)
+
+
+# Shared by all of our caches, so that hit rates can be compared
+cache_requests = counter('cache_requests_total', 'Cache lookups, by cache and result (hit, miss, etc)')
+
+
+def render():
+  output = ''
+  for metric in list(registry.values()):
+    output += f'# HELP {metric.name} {metric.description}\n'
+    output += f'# TYPE {metric.name} {metric.type}\n'
+    for name, key, value in metric.samples():
+      output += f'{name}{format_labels(key)} {value}\n'
+  return output
+
+
+def summary(prefix=''):
+  # A short, human-readable version of the metrics (optionally only those starting with prefix), for !stats
+  output = ''
+  for metric in list(registry.values()):
+    if metric.name.startswith(prefix):
+      output += metric.name + '\n'
+      for line in sorted(metric.summary()):
+        output += '  ' + line + '\n'
+  return output
+
+
+class Handler(BaseHTTPRequestHandler):
+  def do_GET(self):
+    if self.path != '/metrics':
+      self.send_error(404)
+      return
+    body = render().encode('utf-8')
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass # Scraped every few seconds, which is just noise
+
+
+def serve(port, host='127.0.0.1'):
+  # Only listens on localhost by default, since there's no authentication.
+  server = ThreadingHTTPServer((host, port), Handler)
+  Thread(target=server.serve_forever, daemon=True).start()
+  logging.info('Serving metrics on http://%s:%d/metrics', host, server.server_address[1])
+  return server
@@ -0,0 +1,75 @@
+from random import uniform
+from threading import Lock
+
+from . import database, metrics
+from .utils import seconds_since_epoch
+
+class NegativeCache():
+  """
+  Remembers lookups which found nothing (e.g. streamers who aren't speedrunners), so that we don't repeat them on every tick.
+  - Each time a result is confirmed again, the entry moves up a tier (longer TTL), since it's increasingly unlikely to change.
+  - TTLs are jittered, so that entries which were created together (e.g. everyone streaming a big game) don't all expire together.
+  - At most max_revalidations expired entries are re-checked per window. Past that, expired entries are trusted until the next window.
+  Entries are persisted in the database, keyed by (name, key).
+  """
+  def __init__(self, name, ttls, max_revalidations, window=60, jitter=0.2):
+    self.name = name
+    self.ttls = ttls # One TTL per tier, in seconds
+    self.max_revalidations = max_revalidations
+    self.window = window
+    self.jitter = jitter # Fraction of the TTL
+    self.lock = Lock()
+    self.window_start = 0
+    self.window_revalidations = 0
+
+    # Stats
+    self.saved = 0 # Lookups which were answered by a fresh entry
+    self.deferred = 0 # Expired entries which were trusted a little longer, because we were out of revalidations
+    self.revalidated = 0
+    self.confirmed = 0 # Revalidations which found nothing, again
+    self.cleared = 0 # Revalidations which found something
+
+  def should_revalidate(self, key, now=None):
+    """
+    Call when we have a negative result for key. Returns False if the result can be used as-is, or True if it should be looked up again
+    (in which case, call confirm or clear with the result). Keys with no entry are treated as expired.
+    """
+    if now is None:
+      now = seconds_since_epoch()
+    entry = database.get_negative_result(self.name, key)
+    if entry and now < entry[1]:
+      self.saved += 1
+      metrics.cache_requests.inc(cache=self.name, result='hit')
+      return False
+
+    with self.lock:
+      if now >= self.window_start + self.window:
+        self.window_start = now
+        self.window_revalidations = 0
+      if self.window_revalidations >= self.max_revalidations:
+        self.deferred += 1
+        metrics.cache_requests.inc(cache=self.name, result='deferred')
+        return False
+      self.window_revalidations += 1
+      self.revalidated += 1
+    metrics.cache_requests.inc(cache=self.name, result='miss')
+    return True
+
+  def confirm(self, key, now=None):
+    if now is None:
+      now = seconds_since_epoch()
+    entry = database.get_negative_result(self.name, key)
+    tier = min(entry[0] + 1, len(self.ttls) - 1) if entry else 0
+    if entry:
+      self.confirmed += 1
+    expires = now + self.ttls[tier] * uniform(1 - self.jitter, 1 + self.jitter)
+    database.set_negative_result(self.name, key, tier, expires)
+
+  def clear(self, key):
+    if database.get_negative_result(self.name, key):
+      self.cleared += 1
+    database.delete_negative_result(self.name, key)
+
+  def stats(self):
+    return (f'{self.name}: {self.saved} lookups saved, {self.deferred} deferred, '
+           + f'{self.revalidated} revalidated ({self.confirmed} confirmed, {self.cleared} cleared)')
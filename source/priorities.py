@@ -0,0 +1,92 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from threading import BoundedSemaphore, Lock
+from time import monotonic, sleep
+
+from . import deadlines, exceptions, metrics
+
+# Outbound requests are rate limited per host, and each request has a priority class, so that user-facing work goes first.
+# Lower classes may only use the host's budget while it's above their reserve, so when a host is busy, bulk work waits first,
+# then background work, and live announcements and commands still go through. Like budgets, the priority is a context variable.
+
+INTERACTIVE = 0 # Commands which a user is waiting on
+ANNOUNCEMENT = 1 # Go-live announcements and new runs
+BACKGROUND = 2 # Cache refreshes and other scheduled maintenance
+BULK = 3 # Large history pulls (e.g. !verifier_stats)
+NAMES = ['interactive', 'announcement', 'background', 'bulk']
+RESERVES = [0, 0.1, 0.4, 0.7] # Fraction of each host's burst which is kept for higher classes
+
+current = ContextVar('priority', default=BACKGROUND)
+
+@contextmanager
+def priority(value):
+  token = current.set(value)
+  try:
+    yield
+  finally:
+    current.reset(token)
+
+
+wait_seconds = metrics.histogram('priority_wait_seconds', 'Time spent waiting for a host\'s rate limit, by host and priority class')
+
+class HostLimiter():
+  # A token bucket, which refills at rate (requests per second) up to burst
+  def __init__(self, rate, burst):
+    self.rate = rate
+    self.burst = burst
+    self.tokens = burst
+    self.updated = monotonic()
+    self.lock = Lock()
+
+  def try_acquire(self, priority):
+    # Takes a token and returns 0 if the bucket is above the class' reserve, otherwise returns how long to wait before trying again.
+    with self.lock:
+      now = monotonic()
+      self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+      self.updated = now
+      reserve = self.burst * RESERVES[priority]
+      if self.tokens >= reserve + 1:
+        self.tokens -= 1
+        return 0
+      return (reserve + 1 - self.tokens) / self.rate
+
+
+# Documented (or observed) limits. Other hosts (e.g. preview images) are not limited.
+limiters = {
+  'www.speedrun.com': HostLimiter(rate=100 / 60, burst=20), # 100 requests per minute
+  'api.twitch.tv': HostLimiter(rate=800 / 60, burst=80), # 800 points per minute
+  'discord.com': HostLimiter(rate=40, burst=40), # 50 requests per second, globally
+}
+
+# Waiting sleeps on the caller's thread, which is usually from the shared HTTP pool (see make_request.run_async). So that background and
+# bulk work can't take the threads which commands and announcements need, only a few of them may wait at once. The rest give up as if
+# they were out of time, and their work is picked up by the next tick.
+MAX_LOWER_WAITERS = 4
+lower_waiters = BoundedSemaphore(MAX_LOWER_WAITERS)
+
+def wait_for_turn(host):
+  # Blocks until a request to host is allowed for the current priority, or raises DeadlineExceeded if that would be past the deadline.
+  limiter = limiters.get(host)
+  if not limiter:
+    return
+
+  priority_class = current.get()
+  wait = limiter.try_acquire(priority_class)
+  if not wait:
+    return
+  if priority_class >= BACKGROUND and not lower_waiters.acquire(blocking=False):
+    raise exceptions.DeadlineExceeded(f'Too many requests are already waiting to call {host} (priority {NAMES[priority_class]})')
+
+  waited = 0
+  try:
+    while wait:
+      if not deadlines.can_wait(wait):
+        raise exceptions.DeadlineExceeded(f'Ran out of time waiting to call {host} (priority {NAMES[priority_class]})')
+      sleep(wait)
+      waited += wait
+      wait = limiter.try_acquire(priority_class)
+  finally:
+    if priority_class >= BACKGROUND:
+      lower_waiters.release()
+    if waited:
+      wait_seconds.observe(waited, host=host, priority=NAMES[priority_class])
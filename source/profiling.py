@@ -0,0 +1,84 @@
+import cProfile
+import io
+import logging
+import os
+import pstats
+from datetime import datetime
+from pathlib import Path
+from threading import Lock
+from time import monotonic
+
+# Opt-in profiling of ticks and commands, for finding out where the time went when something is slow.
+# When enabled, wrapped calls are run under cProfile. Calls which take longer than their threshold are saved to disk (see prune)
+# and summarized to on_slow. Enable by setting SPEEDRUNBOT_PROFILE=1, or with the !profile admin command.
+# Note that cProfile only sees the calling thread, so work done on other threads (e.g. Helix shards) shows up as waiting on futures.
+
+enabled = os.environ.get('SPEEDRUNBOT_PROFILE', '0') != '0'
+profile_dir = Path(__file__).with_name('profiles')
+MAX_PROFILES = 20 # Only the most recent profiles are kept...
+MAX_BYTES = 20_000_000 # ...up to this much disk space in total
+on_slow = None # Called with (name, duration, summary) for each slow call
+
+# Only one call is profiled at a time (cProfile does not support nesting). Overlapping calls are just run normally.
+profile_lock = Lock()
+
+def run(name, func, *args, threshold=5, **kwargs):
+  if not enabled or not profile_lock.acquire(blocking=False):
+    return func(*args, **kwargs)
+
+  profiler = cProfile.Profile()
+  start = monotonic()
+  try:
+    return profiler.runcall(func, *args, **kwargs)
+  finally:
+    profile_lock.release()
+    duration = monotonic() - start
+    if duration >= threshold:
+      save(name, duration, profiler)
+
+
+def wrap(name, func, threshold=5):
+  # For scheduled jobs, which are called without arguments
+  return lambda: run(name, func, threshold=threshold)
+
+
+def save(name, duration, profiler):
+  try:
+    profile_dir.mkdir(exist_ok=True)
+    path = profile_dir / f'{datetime.now():%Y-%m-%d_%H-%M-%S.%f}_{name}.prof' # Can be viewed with e.g. python -m pstats or snakeviz
+    profiler.dump_stats(path)
+    prune()
+    summary = summarize(profiler)
+  except Exception:
+    logging.exception(f'Failed to save the profile for {name}')
+    return
+
+  logging.info('%s took %.1f seconds, saved profile to %s', name, duration, path)
+  if on_slow:
+    on_slow(name, duration, summary)
+
+
+def prune():
+  profiles = sorted(profile_dir.glob('*.prof')) # Oldest first, since names start with the time
+  total_bytes = sum(profile.stat().st_size for profile in profiles)
+  while profiles and (len(profiles) > MAX_PROFILES or total_bytes > MAX_BYTES):
+    profile = profiles.pop(0)
+    total_bytes -= profile.stat().st_size
+    profile.unlink()
+
+
+def summarize(profiler, limit=15):
+  # The top functions by cumulative time, one per line
+  output = io.StringIO()
+  pstats.Stats(profiler, stream=output).strip_dirs().sort_stats('cumulative').print_stats(limit)
+  lines = output.getvalue().split('\n')
+  start = next(i for i, line in enumerate(lines) if line.lstrip().startswith('ncalls')) # Skip the header
+  return '\n'.join(line.rstrip() for line in lines[start:] if line.strip())
+
+
+def get_stats():
+  profiles = sorted(profile_dir.glob('*.prof'))
+  output = f'Profiling is {"enabled" if enabled else "disabled"}. {len(profiles)} slow profiles saved'
+  if profiles:
+    output += f', most recently `{profiles[-1].name}`'
+  return output
@@ -0,0 +1,47 @@
+from collections import namedtuple
+
+# Actions which announce_live_channels needs to take, to bring the announced streams in line with the live streams.
+Announce = namedtuple('Announce', ['stream']) # A stream went live: send a new announcement
+EditTitle = namedtuple('EditTitle', ['announced', 'title']) # An announced stream changed its title
+RefreshPreview = namedtuple('RefreshPreview', ['announced']) # An announced stream's preview image expired
+Offline = namedtuple('Offline', ['announced']) # An announced stream is no longer live
+GameChange = namedtuple('GameChange', ['announced', 'stream']) # An announced stream is now live in another (tracked) game
+
+def diff_streams(announced_streams, live_streams, now, unconfirmed=()):
+  """
+  Compare the previously announced streams against a snapshot of live streams, and return a list of actions.
+  This function is pure (no network or database access), so that it can be tested and benchmarked with synthetic data.
+  - announced_streams is a list of announced streams (as stored in the database)
+  - live_streams is a map of name: stream. Streams which were only *possibly* offline should already have been resolved.
+  - now is the current time, in seconds since the epoch (used to check preview expiry)
+  - unconfirmed is a set of names which are missing from live_streams, but might still be live. These are left alone until the next tick.
+  """
+  announced_games = {} # name: set of games which this stream is announced in. A stream is usually only announced in one game.
+  for announced in announced_streams:
+    announced_games.setdefault(announced.name, set()).add(announced.game)
+
+  actions = []
+  for name, stream in live_streams.items():
+    if name not in announced_games:
+      actions.append(Announce(stream))
+
+  game_changes = set() # Names which already have a GameChange action, so that we only announce the new game once.
+  for announced in announced_streams:
+    name = announced.name
+    stream = live_streams.get(name)
+    if not stream:
+      if name not in unconfirmed:
+        actions.append(Offline(announced))
+    elif stream.game != announced.game:
+      if stream.game in announced_games[name] or name in game_changes:
+        actions.append(Offline(announced)) # The new game is (or will be) announced separately, so this announcement is stale.
+      else:
+        game_changes.add(name)
+        actions.append(GameChange(announced, stream))
+    else:
+      if stream.title != announced.title:
+        actions.append(EditTitle(announced, stream.title))
+      if now > announced.preview_expires:
+        actions.append(RefreshPreview(announced))
+
+  return actions
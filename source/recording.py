@@ -0,0 +1,130 @@
+import gzip
+import re
+from collections import deque
+from datetime import timedelta
+from http.client import responses
+from threading import Lock
+from time import monotonic, sleep
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+from . import json_codec, make_request
+
+# Record real API traffic to an archive, and replay it later (e.g. in benchmarks), so that performance work can be tested against
+# realistic traffic offline and repeatably. Install either one with start(), which replaces the transport used by make_request.
+# Archives are gzipped JSON lines, one request/response pair per line. Secrets are redacted before anything is written.
+
+# Query parameters, JSON keys and response keys which hold secrets
+SECRET_KEYS = {'client_id', 'client_secret', 'access_token', 'refresh_token', 'token', 'secret'}
+# Interaction tokens are part of the URL path
+SECRET_PATHS = re.compile(r'(/(?:interactions|webhooks)/\d+/)[^/]+')
+# Only headers which the bot reads are kept, which also drops cookies
+RECORDED_HEADERS = ['Content-Type', 'Expires', 'Location', 'Retry-After']
+
+def redact(value):
+  if isinstance(value, dict):
+    return {key: 'REDACTED' if key in SECRET_KEYS else redact(item) for key, item in value.items()}
+  elif isinstance(value, list):
+    return [redact(item) for item in value]
+  return value
+
+
+def get_key(method, url, params=None, **kwargs):
+  # Requests are matched on their method and (redacted) URL, including the query. Bodies are not, since e.g. embeds contain random data.
+  url = requests.Request(method, url, params=redact(params or {})).prepare().url
+  return method, SECRET_PATHS.sub(r'\1REDACTED', url)
+
+
+class Recorder():
+  def __init__(self, path):
+    self.file = gzip.open(path, 'at', encoding='utf-8')
+    self.lock = Lock()
+    self.start = monotonic()
+    self.count = 0
+
+  def __call__(self, method, url, *args, **kwargs):
+    start = monotonic()
+    r = make_request.session.request(method, url, *args, **kwargs)
+    entry = {
+      'at': round(start - self.start, 3), # Seconds since recording started
+      'key': get_key(method, url, **kwargs),
+      'status': r.status_code,
+      'headers': {name: r.headers[name] for name in RECORDED_HEADERS if name in r.headers},
+      'elapsed': round(monotonic() - start, 3),
+    }
+    try:
+      entry['json'] = redact(json_codec.loads(r.content)) if r.content else None
+    except ValueError:
+      entry['text'] = r.text
+
+    with self.lock:
+      self.file.write(json_codec.dumps(entry) + '\n')
+      self.count += 1
+    return r
+
+  def close(self):
+    with self.lock:
+      self.file.close()
+
+
+class Replayer():
+  """
+  Serves recorded responses, waiting for the recorded latency times latency_scale (0 to not wait at all).
+  Identical requests are answered in the order they were recorded, and the last response is repeated once they run out.
+  Requests which were never recorded fail to connect.
+  """
+  def __init__(self, path, latency_scale=1.0):
+    self.latency_scale = latency_scale
+    self.lock = Lock()
+    self.responses = {} # key: deque of entries
+    self.replayed = 0
+    self.missed = 0
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+      try:
+        for line in f:
+          entry = json_codec.loads(line)
+          self.responses.setdefault(tuple(entry['key']), deque()).append(entry)
+      except (EOFError, json_codec.JSONDecodeError):
+        pass # The recording was cut off (e.g. the bot was killed), but everything before that is still usable
+
+  def __call__(self, method, url, *args, **kwargs):
+    key = get_key(method, url, **kwargs)
+    with self.lock:
+      entries = self.responses.get(key)
+      if not entries:
+        self.missed += 1
+        raise requests.exceptions.ConnectionError(f'No recorded response for {method} {key[1]}')
+      entry = entries.popleft() if len(entries) > 1 else entries[0]
+      self.replayed += 1
+
+    if self.latency_scale:
+      sleep(entry['elapsed'] * self.latency_scale)
+
+    r = requests.Response()
+    r.status_code = entry['status']
+    r.reason = responses.get(r.status_code, '')
+    r.headers = CaseInsensitiveDict(entry['headers'])
+    r.url = key[1]
+    r.encoding = 'utf-8'
+    r.elapsed = timedelta(seconds=entry['elapsed'])
+    if 'text' in entry:
+      r._content = entry['text'].encode('utf-8')
+    else:
+      r._content = json_codec.dumps_bytes(entry['json']) if entry['json'] is not None else b''
+    return r
+
+  def close(self):
+    pass
+
+
+def start(transport):
+  # Route all requests through a Recorder or Replayer, until stop() is called.
+  make_request.transport = transport
+  return transport
+
+
+def stop():
+  if make_request.transport:
+    make_request.transport.close()
+    make_request.transport = None
@@ -0,0 +1,71 @@
+from dataclasses import dataclass
+
+# Record types for the data we pass around the most. These are slotted (no per-instance __dict__), and only keep the fields we actually use,
+# so that e.g. a live stream doesn't keep the entire Helix JSON alive. Database records are built straight from rows (see database.record_cursor),
+# so their fields must be declared in the same order as the table's columns. __slots__ is written out by hand, since dataclass(slots=True)
+# needs Python 3.10 (see compiling_python.txt), so it must list the same fields.
+
+@dataclass
+class Stream:
+  __slots__ = ('name', 'title', 'game', 'twitch_game_id', 'url', 'preview')
+  name: str
+  title: str
+  game: str
+  twitch_game_id: str
+  url: str
+  preview: str # URL of the preview image
+
+  @staticmethod
+  def from_helix(stream):
+    return Stream(
+      name=stream['user_name'],
+      title=stream['title'],
+      game=stream['game_name'],
+      twitch_game_id=stream['game_id'],
+      url='https://www.twitch.tv/' + stream['user_name'],
+      preview=stream['thumbnail_url'].format(width=1920, height=1080),
+    )
+
+
+@dataclass
+class AnnouncedStream: # Columns of announced_streams
+  __slots__ = ('name', 'game', 'title', 'url', 'preview', 'channel_id', 'message_id', 'start', 'preview_expires')
+  name: str
+  game: str
+  title: str
+  url: str
+  preview: str
+  channel_id: int
+  message_id: int
+  start: float
+  preview_expires: float
+
+
+@dataclass
+class User: # Columns of users
+  __slots__ = ('twitch_username', 'src_id', 'fetch_time')
+  twitch_username: str
+  src_id: str # None if the user is not a speedrunner
+  fetch_time: float
+
+
+@dataclass
+class UnverifiedRun: # Columns of unverified_runs
+  __slots__ = ('run_id', 'src_game_id', 'submitted', 'channel_id', 'message_id')
+  run_id: str
+  src_game_id: str
+  submitted: float
+  channel_id: int
+  message_id: int
+
+
+@dataclass
+class CatalogGame: # Columns of game_catalog
+  __slots__ = ('src_game_id', 'name', 'aliases', 'twitch_name', 'twitch_game_id', 'src_series_id', 'last_fetched')
+  src_game_id: str
+  name: str # The international name on SRC
+  aliases: str # Newline-separated. Other names and abbreviations, plus any searches which found this game.
+  twitch_name: str # None if SRC doesn't know the twitch name
+  twitch_game_id: str # None until looked up
+  src_series_id: str # None if the game is not part of a series
+  last_fetched: float
@@ -0,0 +1,187 @@
+import asyncio
+import logging
+from random import uniform
+from time import monotonic
+
+from . import deadlines, exceptions, metrics, priorities
+from .make_request import run_async
+
+job_seconds = metrics.histogram('job_seconds', 'Time taken by each tick of a scheduled job, by job')
+
+class Job():
+  def __init__(self, name, func, interval, jitter, budget, max_requests, priority):
+    self.name = name
+    self.func = func # A blocking function, which is run on the shared HTTP pool.
+    self.interval = interval # Time between the *starts* of consecutive ticks (fixed-rate), in seconds.
+    self.jitter = jitter # Maximum random delay added to each tick, in seconds. Keeps jobs from hitting the same APIs in lockstep.
+    self.budget = budget # Time limit for each tick, in seconds. See deadlines.py
+    self.max_requests = max_requests # Limit on HTTP requests for each tick, or None
+    self.priority = priority # Priority class of the job's requests, see priorities.py
+    self.running = False
+    self.failures = 0 # Consecutive network failures, used for backoff.
+    self.resume_at = 0 # While backing off, ticks scheduled before this (monotonic) time are skipped.
+    self.triggered = False # Whether there's a pending trigger (see Scheduler.trigger)
+    self.rerun = False # Whether a trigger arrived while a tick was running, so another tick should start once it's done
+    self.task = None
+
+    # Stats
+    self.runs = 0
+    self.errors = 0
+    self.skipped = 0 # Ticks which were not run because the previous tick was still running (or we were backing off)
+    self.overruns = 0 # Ticks which ran out of budget
+    self.last_duration = 0
+    self.max_duration = 0
+    self.total_duration = 0
+    self.last_lag = 0 # How late the last tick started, compared to its schedule (not including jitter)
+    self.max_lag = 0
+
+  def stats(self):
+    average = self.total_duration / self.runs if self.runs else 0
+    return (f'{self.name}: {self.runs} runs, {self.errors} errors, {self.skipped} skipped, {self.overruns} over budget, '
+           + f'duration {self.last_duration:.2f}s (avg {average:.2f}s, max {self.max_duration:.2f}s), '
+           + f'lag {self.last_lag:.2f}s (max {self.max_lag:.2f}s)')
+
+
+class Scheduler():
+  def __init__(self, max_backoff=60 * 60):
+    self.jobs = {}
+    self.max_backoff = max_backoff # Longest time a job will back off for after repeated network errors, in seconds.
+    self.on_error = None # Called with a cause string when a job raises. Used to report crashes.
+    self.loop = None # The event loop which the jobs are running on, once started.
+
+
+  def add_job(self, name, func, interval, jitter=None, budget=None, max_requests=None, priority=priorities.BACKGROUND):
+    if jitter is None:
+      jitter = interval / 10
+    if budget is None:
+      budget = interval # By default, a tick should finish before the next one is due
+    self.jobs[name] = Job(name, func, interval, jitter, budget, max_requests, priority)
+
+
+  async def run(self):
+    self.loop = asyncio.get_running_loop()
+    # None of the job loops exit, so this is effectively forever.
+    await asyncio.gather(*(self.run_job(job) for job in self.jobs.values()))
+
+
+  async def run_job(self, job):
+    next_run = monotonic()
+    while 1: # This loop does not exit
+      await asyncio.sleep(max(0, next_run - monotonic()) + uniform(0, job.jitter))
+      scheduled = next_run
+      # Fixed-rate: the next tick is scheduled relative to this tick's *scheduled* start, so a slow tick doesn't push back every later tick.
+      next_run += job.interval
+      if monotonic() > next_run: # We're so late that we've missed whole ticks (e.g. the system was suspended). Don't try to catch up.
+        next_run = monotonic()
+
+      self.start_tick(job, scheduled)
+
+
+  def start_tick(self, job, scheduled):
+    if job.running or monotonic() < job.resume_at:
+      job.skipped += 1
+      return
+
+    job.last_lag = monotonic() - scheduled
+    job.max_lag = max(job.max_lag, job.last_lag)
+    job.running = True # Set before the task starts, so that the next tick sees it even if this one hasn't been scheduled yet.
+    job.task = asyncio.create_task(self.tick(job))
+
+
+  def trigger(self, name, delay=0):
+    """
+    Run a job early (e.g. in response to a push notification), without changing its regular schedule. Safe to call from any thread.
+    Triggers which arrive while another trigger is pending are coalesced into it. If the job is already running when the trigger fires,
+    another tick runs as soon as it's done, since the running tick may have already missed whatever caused the trigger.
+    """
+    job = self.jobs.get(name)
+    if not job or not self.loop or job.triggered: # Not running yet, or already triggered
+      return
+    job.triggered = True
+
+    def on_trigger():
+      job.triggered = False
+      if job.running:
+        job.rerun = True
+      else:
+        self.start_tick(job, monotonic())
+    self.loop.call_soon_threadsafe(self.loop.call_later, delay, on_trigger)
+
+
+  async def tick(self, job):
+    start = monotonic()
+    cause = None
+    with deadlines.budget(job.name, job.budget, job.max_requests) as budget, priorities.priority(job.priority): # Copied onto the pool by run_async
+      try:
+        await run_async(job.func)
+        job.failures = 0
+      except exceptions.DeadlineExceeded as e:
+        # Not the network's fault, so no backoff. The remaining work will be picked up by the next tick.
+        job.overruns += 1
+        logging.warning(str(e))
+      except exceptions.CircuitOpen as e:
+        # The host is already known to be down (see circuit_breakers.py), so there's nothing to report. The breaker decides when to try again.
+        job.errors += 1
+        logging.warning(f'{job.name} stopped early: {e}')
+      except exceptions.NetworkError:
+        job.errors += 1
+        job.failures += 1
+        # Exponential backoff: skip 1, 3, 7, ... ticks after consecutive network errors.
+        backoff = min(self.max_backoff, job.interval * (2 ** job.failures - 1))
+        job.resume_at = monotonic() + backoff
+        logging.exception(f'A network error occurred during {job.name}, backing off for {backoff} seconds')
+        cause = f'forever-network: {job.name}'
+      except Exception:
+        job.errors += 1
+        logging.exception(f'catch-all for {job.name}')
+        cause = f'forever-generic: {job.name}'
+      finally:
+        job.running = False
+        job.runs += 1
+        job.last_duration = monotonic() - start
+        job.max_duration = max(job.max_duration, job.last_duration)
+        job.total_duration += job.last_duration
+        job_seconds.observe(job.last_duration, job=job.name)
+        logging.info(budget.stats())
+
+    if job.rerun:
+      job.rerun = False
+      self.start_tick(job, monotonic())
+    if cause:
+      await self.report_error(cause) # Outside of the budget, which may already be spent
+
+  async def report_error(self, cause):
+    if self.on_error:
+      await run_async(self.on_error, cause)
+
+
+  def get_stats(self):
+    return '\n'.join(job.stats() for job in self.jobs.values())
+
+
+class AdaptiveInterval():
+  """
+  Tracks a separate polling interval per key (e.g. per game), which shrinks right after activity and grows while the key is idle.
+  The interval is proportional to how long the key has been idle, clamped to [min_interval, max_interval].
+  With the default ratio, a game which had a submission an hour ago is polled every 2.5 minutes, and one which has been idle for a day is polled hourly.
+  """
+  def __init__(self, min_interval, max_interval, idle_ratio=1/24):
+    self.min_interval = min_interval
+    self.max_interval = max_interval
+    self.idle_ratio = idle_ratio
+    self.last_activity = {}
+    self.next_poll = {}
+
+  def is_due(self, key, now):
+    return now >= self.next_poll.get(key, 0)
+
+  # Call after polling a key. last_activity is the (epoch) time of the latest known activity, if any.
+  def update(self, key, now, last_activity=None):
+    if last_activity is not None:
+      self.last_activity[key] = max(last_activity, self.last_activity.get(key, last_activity))
+    # If we have never seen any activity, treat the key as idle since the first poll.
+    idle_time = now - self.last_activity.setdefault(key, now)
+
+    interval = min(self.max_interval, max(self.min_interval, idle_time * self.idle_ratio))
+    self.next_poll[key] = now + interval
+    return interval
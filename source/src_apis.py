@@ -1,324 +1,443 @@
-import logging
-from datetime import timedelta
-
-from . import database, exceptions
-from .make_request import make_request, make_head_request
-from .utils import seconds_since_epoch
-
-ONE_HOUR  = (3600)
-ONE_DAY   = (3600 * 24)
-ONE_WEEK  = (3600 * 24 * 7)
-ONE_MONTH = (3600 * 24 * 7 * 30)
-SRC_NO_SERIES = 'yr4gon12' # SRC uses this ID for games with no series.
-
-api = 'https://www.speedrun.com/api/v1'
-embeds = 'game,players,level,category,category.variables'
-
-def get_src_id(twitch_username):
-  if user := database.get_user(twitch_username):
-    if user['src_id']:
-      # Streamer found, is a known speedrunner.
-      return user['src_id']
-    # Streamer is found, but not a speedrunner.
-    if seconds_since_epoch() < user['fetch_time'] + ONE_WEEK:
-      # Last check was <1 week ago, return cached.
-      return user['src_id']
-
-  # Make a network call to determine if the streamer is a speedrunner.
-  try:
-    j = make_request('GET', f'{api}/users', params={'twitch': twitch_username})
-  except exceptions.NetworkError:
-    logging.exception(f'Failed to look up src user for twitch_username={twitch_username}, assuming non-runner')
-    return None
-
-  if len(j['data']) == 0:
-    database.add_user(twitch_username, None)
-    return None
-  src_id = j['data'][0]['id']
-  if not user:
-    # When initially adding a user, we set the fetch_time to 0 so that further lookups will fetch their PBs.
-    # TODO: This seems like a hack. If I wind up rewriting this to do multi-user-fetch, try to do something smarter.
-    database.add_user(twitch_username, src_id, 0)
-  return src_id
-
-
-def runner_runs_game(twitch_username, src_id, src_game_id):
-  if database.has_personal_best(src_id, src_game_id):
-    return True
-
-  if user := database.get_user(twitch_username):
-    if seconds_since_epoch() < user['fetch_time'] + ONE_DAY:
-      # Last check was <1 day ago, don't fetch again
-      return False
-
-  # If a game was just recently added, the leaderboards might be locked down -- so we won't find any runs.
-  # For equity, search for a PB for any game in the series to determine if the streamer is a speedrunner.
-  games_in_series = get_games_in_series(src_game_id)
-  
-  try:
-    personal_bests = get_personal_bests(src_id, games_in_series)
-  except exceptions.NetworkError:
-    logging.exception(f'Could not fetch {src_id} personal bests for any of {games_in_series}, assuming non-speedrunner')
-    return False
-
-  database.update_user_fetch_time(twitch_username)
-
-  if len(personal_bests) == 0:
-    return False
-
-  database.add_personal_best(src_id, src_game_id)
-  return True
-
-
-def get_games_in_series(src_game_id):
-  series_id, fetch_time = database.get_game_series(src_game_id)
-
-  # Never fetched, or last fetch was > 1 day ago
-  if not fetch_time or seconds_since_epoch() > fetch_time + ONE_DAY:
-    try:
-      j = make_request('GET', f'{api}/games/{src_game_id}')
-      series_uri = next((link['uri'] for link in j['data']['links'] if link['rel'] == 'series'), None)
-      if series_uri:
-        series_id = series_uri.split('/api/v1/series/')[1]
-        database.set_game_series(src_game_id, series_id) # Save the series ID for this game before we go any further
-
-      j = make_request('GET', f'{api}/series/{series_id}/games')
-      for game in j['data']:
-        database.set_game_series(game['id'], series_id)
-
-    except exceptions.NetworkError:
-      logging.exception(f'Could not find series for {src_game_id}, assuming no games in series')
-
-  if not series_id or series_id == SRC_NO_SERIES:
-    return [src_game_id] # No series id, the series is just [this game] and nothing else.
-
-  return database.get_games_in_series(series_id)
-
-
-def get_personal_bests(src_id, src_game_ids, **params):
-  # Sadly, there doesn't seem to be a way to call the SRC API to get PBs in multiple games, so we're stuck making one call and sorting through the results.
-  j = make_request('GET', f'{api}/users/{src_id}/personal-bests', params=params)
-  return [run for run in j['data'] if run['run']['game'] in src_game_ids]
-
-
-def get_game(game_name):
-  j = make_request('GET', f'{api}/games', params={'name': game_name})
-  if len(j['data']) == 0:
-    raise exceptions.CommandError(f'Could not find game `{game_name}` on Speedrun.com')
-
-  if len(j['data']) == 1:
-    return j['data'][0]
-
-  possible_matches = []
-  for game in j['data']:
-    possible_match = game['names']['international']
-    if possible_match == game_name: # If there are multiple options, but one is an exact match, return the exact match.
-      return game
-    possible_matches.append(f'`{possible_match}`')
-
-  suggestions = ', '.join(possible_matches[:10]) # Only show a max of 10 matches, for brevity's sake
-  raise exceptions.CommandError(f'Found {len(possible_matches)} possible matches for game `{game_name}` on Speedrun.com -- Try one of these options:\n' + suggestions)
-
-
-def search_src_user(username):
-  j = make_request('GET', f'{api}/users', params={'name': username})
-  if len(j['data']) == 0:
-    raise exceptions.CommandError(f'Could not find user `{username}` on Speedrun.com')
-
-  if len(j['data']) == 1:
-    return j['data'][0]['id']
-
-  possible_matches = []
-  for user in j['data']:
-    possible_match = user['names']['international']
-    if possible_match == username:
-      return user['id']
-    possible_matches.append(f'`{possible_match}`')
-
-  suggestions = ', '.join(possible_matches[:10]) # Only show a max of 10 matches, for brevity's sake
-  raise exceptions.CommandError(f'Found {len(possible_matches)} possible matches for user `{username}` on Speedrun.com -- Try one of these options:\n' + suggestions)
-
-
-def get_run_status(run_id):
-  j = make_request('GET', f'{api}/runs/{run_id}', allow_4xx=True)
-  if 'status' in j:
-    if j['status'] == 404:
-      return 'deleted'
-    else:
-      return j['message']
-
-  run_status = j['data']['status']['status']
-  if run_status == 'rejected':
-    return 'rejected'
-  elif run_status == 'verified':
-    return 'verified'
-
-  # The underlying SRC APIs do not actually 'delete' runs, they seem to simply unlink them in their database.
-  # Thus, a submission which is deleted by the runner will still show as 'new' (but not be returned by the get_runs call).
-  # Double-check that this run was deleted according to the frontend.
-  status_code, _ = make_head_request(j['data']['weblink'])
-  if status_code == 404:
-    return 'deleted'
-  else:
-    return run_status # probably 'new'
-
-
-def get_runs(**params):
-  if 'game' not in params and 'category' not in params:
-    raise exceptions.CommandError('You can only get Speedrun.com runs with a game or a category')
-
-  params['offset'] = 0
-  params['max'] = 100 # Undocumented parameter, gets 100 runs at once.
-  params['embed'] = embeds
-
-  runs = []
-  try:
-    j = make_request('GET', f'{api}/runs', params=params)
-    while 1:
-      runs += j['data']
-
-      next_link = next((link['uri'] for link in j['pagination']['links'] if link['rel'] == 'next'), None)
-      if next_link:
-        j = make_request('GET', next_link)
-        continue
-      break # No more results
-  except exceptions.NetworkError:
-    logging.exception(f'Failed to load runs for {params}, assuming empty')
-    return runs
-
-  return runs
-
-
-def get_leaderboard(game, category, level=None, variables=None):
-  params = {}
-  if variables is not None:
-    params = {f'var-{key}': value['id'] for key, value in variables.items()}
-  if level:
-    j = make_request('GET', f'{api}/leaderboards/{game}/level/{level}/{category}', params=params)
-  else:
-    j = make_request('GET', f'{api}/leaderboards/{game}/category/{category}', params=params)
-
-  # This does not support continue, so I assume it just reports the entire leaderboard.
-  for run in j['data']['runs']:
-    run['run']['place'] = run['place']
-    yield run['run']
-
-
-# NOTE: Run must be fetched with at least embed=category,category.variables
-# Returns a mapping of variable_id: {data}, where data is an arbitrary set of properties from SRC, including 'id'.
-def get_subcategories(run):
-  all_subcategories = {}
-  for variable in run['category']['data']['variables']['data']:
-    if not variable['is-subcategory']:
-      continue
-    all_subcategories[variable['id']] = variable['values']['values']
-
-  run_subcategories = {}
-  for variable_id, value_id in run['values'].items():
-    if variable_id not in all_subcategories:
-      continue # Not a subcategory
-
-    value = all_subcategories[variable_id][value_id]
-    value['id'] = value_id
-    run_subcategories[variable_id] = value
-
-  return run_subcategories
-
-
-def parse_name(player):
-  if 'names' in player:
-    return player['names']['international']
-  elif 'name' in player:
-    return player['name']
-  else:
-    return player['id']
-
-
-# NOTE: Run data must be fetched with embeds
-def get_current_pb(new_run):
-  game = new_run['game']
-  category = new_run['category']['data']['id']
-  players = set(parse_name(player) for player in new_run['players']['data'])
-  time = new_run['times']['primary_t']
-  level = new_run['level']['data']['id'] if isinstance(new_run['level']['data'], dict) else None
-
-  subcategories = get_subcategories(new_run)
-  try:
-    leaderboard = get_leaderboard(game, category, level, subcategories)
-  except exceptions.NetworkError:
-    logging.exception(f'Failed to load the leaderboard for {game}, assuming no existing PB')
-    return None
-
-  for run in leaderboard:
-    if 'place' not in new_run and time <= run['times']['primary_t']:
-      new_run['place'] = run['place']
-    if players == set(parse_name(player) for player in run['players']):
-      return run
-
-
-# NOTE: Run data must be fetched with embeds
-def run_to_string(run, current_pb=None):
-  game = run['game']['data']['names']['international']
-  category = run['category']['data']['name']
-
-  if isinstance(run['level']['data'], dict):
-    category = run['level']['data']['name'] + f': {category}'
-
-  subcategories = get_subcategories(run)
-  for value in subcategories.values():
-    category += f' ({value["label"]})'
-
-  time = timedelta(seconds=run['times']['primary_t'])
-
-  runners = ', '.join(map(parse_name, run['players']['data']))
-
-  output = f'`{game} | {category}` in {time} by {runners}'
-  if 'place' in run:
-    n = int(run['place'])
-    # https://stackoverflow.com/a/36977549
-    ordinal = {1:'st', 2:'nd', 3:'rd'}.get(n%100 if n%100<20 else n%10, 'th')
-    output += f', which would put them in {n}{ordinal} place'
-  if current_pb:
-    current_pb_time = timedelta(seconds=current_pb['times']['primary_t'])
-    n = int(current_pb['place'])
-    # https://stackoverflow.com/a/36977549
-    ordinal = {1:'st', 2:'nd', 3:'rd'}.get(n%100 if n%100<20 else n%10, 'th')
-    output += f'\nAn improvement over their current PB of {current_pb_time} ({n}{ordinal} place)'
-  output += f'\n<{run["weblink"]}>'
-  return output
-
-
-# Undocumented PHP APIs, that I apparently *am* allowed to call.
-# https://discord.com/channels/157645920324943872/343897241766854656/902321525263319110
-# (Can't access it, but the image says "no support nor api stability provided")
-# Hopefully they stop using numeric IDs.
-
-# Get latest runs for a game series (note: needs numeric ID, which comes from ???)
-# https://www.speedrun.com/ajax_latestleaderboard.php?series=18748
-# Get latest runs for all games (personalized if signed in)
-# https://www.speedrun.com/ajax_latestleaderboard.php?amount=100
-# Get the latest runs for a set of games (note: needs numeric IDs)
-# https://www.speedrun.com/ajax_latestleaderboard.php?games=1545,1546,1547,4158,1548,1549,2147,2048,2222,2223,2224,6353,2225,7967
-
-# Get game streams
-# https://www.speedrun.com/ajax_streams.php?game=talos_principle&country=&haspb=on&following=off&start=0
-
-
-# Edit run / Submit run
-# When you submit a run, you are granted an ID (temporary, I assume) on page load. It lives in the <form id="editform"> object, and NOWHERE ELSE.
-# Also, you are given a CSRF token, as a <meta> attribute, and also inside a few <input type="hidden" name="csrftoken"> objects.
-# playerselect=0 means "I am an admin, I was not part of this run". Otherwise, 1-4 means "I was player # whatever".
-# The variable IDs are visible in the page HTML, if nothing else.
-# POST https://www.speedrun.com/ajax_editrun.php?id=abcd1234&game=2364&action=submit
-# category=All_Sigils
-# &player1=foo&playerselect=0
-# &hour=1&minute=4&second=23&milliseconds=
-# &loadshour=1&loadsminute=4&loadssecond=23&loadsmilliseconds=
-# &variable16422=54487
-# &variable12500=42106
-# &platform=31
-# &date=2021-06-12
-# &video=https%3A%2F%2Fwww.youtube.com%2Fwatch%3Fv%3Dsomething
-# &splitsio=
-# &comment=URL+encoded+comment%0D%0AWith+Octets
-# &csrftoken=probably-important
+import logging
+from datetime import timedelta
+
+from . import circuit_breakers, database, deadlines, exceptions, metrics
+from .negative_cache import NegativeCache
+from .make_request import make_request, make_head_request, run_async
+from .utils import seconds_since_epoch
+
+ONE_HOUR  = (3600)
+ONE_DAY   = (3600 * 24)
+ONE_WEEK  = (3600 * 24 * 7)
+ONE_MONTH = (3600 * 24 * 30)
+SRC_NO_SERIES = 'yr4gon12' # SRC uses this ID for games with no series.
+
+host = 'www.speedrun.com'
+api = f'https://{host}/api/v1'
+embeds = 'game,players,level,category,category.variables'
+
+# Most streamers of a game aren't speedrunners, so these are re-checked rarely, and only a few at a time.
+non_runners = NegativeCache('non_runners', ttls=[ONE_DAY, ONE_WEEK, 2 * ONE_WEEK, ONE_MONTH], max_revalidations=10)
+
+def get_src_id(twitch_username):
+  if user := database.get_user(twitch_username):
+    if user.src_id:
+      # Streamer found, is a known speedrunner.
+      return user.src_id
+    # Streamer is found, but not a speedrunner. Revalidating them is optional, so it waits for a tick with budget to spare (and for SRC to be up).
+    if circuit_breakers.is_open(host) or not deadlines.has_room('revalidate_non_runner') or not non_runners.should_revalidate(twitch_username.lower()):
+      return None
+  elif not deadlines.has_room('src_user_lookup', reserve=0.1):
+    return None # Unknown streamer, but the tick is almost out of budget. They'll be looked up next tick.
+
+  # Make a network call to determine if the streamer is a speedrunner.
+  try:
+    j = make_request('GET', f'{api}/users', params={'twitch': twitch_username})
+  except exceptions.CircuitOpen:
+    return None # SRC is down. Known runners were found above, and everyone else is looked up once it recovers.
+  except exceptions.NetworkError:
+    logging.exception(f'Failed to look up src user for twitch_username={twitch_username}, assuming non-runner')
+    return None
+
+  if len(j['data']) == 0:
+    database.add_user(twitch_username, None)
+    non_runners.confirm(twitch_username.lower())
+    return None
+  src_id = j['data'][0]['id']
+  database.add_user(twitch_username, src_id)
+  non_runners.clear(twitch_username.lower())
+  return src_id
+
+
+def runner_runs_game(twitch_username, src_id, src_game_id):
+  if database.has_personal_best(src_id, src_game_id):
+    return True
+
+  # If a game was just recently added, the leaderboards might be locked down -- so we won't find any runs.
+  # For equity, search for a PB for any game in the series to determine if the streamer is a speedrunner.
+  # Until the series has been fetched, only this game is checked. Since the snapshot covers all games, related PBs are found once the series is known.
+  games_in_series = get_games_in_series(src_game_id) or [src_game_id]
+
+  try:
+    src_game_ids, _ = get_pb_snapshot(src_id)
+  except exceptions.CircuitOpen:
+    return False # SRC is down, and we have no snapshot for this runner yet
+  except exceptions.DeadlineExceeded:
+    return False # The tick is out of time, they'll be checked again next tick
+  except exceptions.NetworkError:
+    logging.exception(f'Could not fetch {src_id} personal bests for any of {games_in_series}, assuming non-speedrunner')
+    return False
+
+  if src_game_ids.isdisjoint(games_in_series):
+    return False
+
+  database.add_personal_best(src_id, src_game_id)
+  return True
+
+
+def get_games_in_series(src_game_id):
+  """
+  Returns the (cached) list of games in the same series as this game, or None if the series has never been fetched.
+  This never makes network calls, since it's used while classifying live streams. Series are fetched by warm_game_series instead.
+  """
+  series_id, fetch_time = database.get_game_series(src_game_id)
+  if fetch_time is None:
+    return None
+
+  if not series_id or series_id == SRC_NO_SERIES:
+    return [src_game_id] # No series id, the series is just [this game] and nothing else.
+
+  return database.get_games_in_series(series_id)
+
+
+def fetch_game_series(src_game_id):
+  series_id = SRC_NO_SERIES
+  j = make_request('GET', f'{api}/games/{src_game_id}')
+  series_uri = next((link['uri'] for link in j['data']['links'] if link['rel'] == 'series'), None)
+  if series_uri:
+    series_id = series_uri.split('/api/v1/series/')[1]
+  database.set_game_series(src_game_id, series_id) # Save the series ID for this game before we go any further
+
+  if series_id != SRC_NO_SERIES:
+    j = make_request('GET', f'{api}/series/{series_id}/games')
+    for game in j['data']:
+      database.set_game_series(game['id'], series_id)
+
+
+def warm_game_series():
+  """
+  Refresh series membership for every tracked game shortly before it expires (stale-while-revalidate).
+  Until a refresh succeeds, get_games_in_series keeps returning the stale membership.
+  """
+  for _, _, src_game_id in database.get_all_games():
+    _, fetch_time = database.get_game_series(src_game_id)
+    if fetch_time and seconds_since_epoch() < fetch_time + ONE_DAY - 2 * ONE_HOUR:
+      continue # Still fresh
+
+    try:
+      fetch_game_series(src_game_id)
+    except exceptions.CircuitOpen:
+      return # SRC is down, the stale series are still usable
+    except exceptions.NetworkError:
+      logging.exception(f'Could not refresh series for {src_game_id}, will retry next time')
+
+
+def get_pb_snapshot(src_id, full=False):
+  """
+  Returns (set of src_game_ids which the user has PBs in, list of PBs or None). PBs are only included if full is set, and have embeds.
+  Cached snapshots are returned even if they're old, since refresh_pb_snapshots keeps them fresh. PBs are shown to users, so they're only cached for an hour.
+  """
+  if snapshot := database.get_pb_snapshot(src_id):
+    src_game_ids, runs, fetch_time = snapshot
+    if not full:
+      metrics.cache_requests.inc(cache='pb_snapshots', result='hit')
+      return src_game_ids, None
+    if runs is not None and seconds_since_epoch() < fetch_time + ONE_HOUR:
+      metrics.cache_requests.inc(cache='pb_snapshots', result='hit')
+      return src_game_ids, runs
+  metrics.cache_requests.inc(cache='pb_snapshots', result='miss')
+  return fetch_pb_snapshot(src_id, full)
+
+
+def fetch_pb_snapshot(src_id, full=False):
+  # Sadly, there doesn't seem to be a way to call the SRC API to get PBs in specific games, so we fetch all of them and share the results across games.
+  params = {'embed': embeds} if full else {}
+  j = make_request('GET', f'{api}/users/{src_id}/personal-bests', params=params)
+  src_game_ids = {run['run']['game'] for run in j['data']}
+  runs = j['data'] if full else None
+  database.set_pb_snapshot(src_id, src_game_ids, runs)
+  return src_game_ids, runs
+
+
+def refresh_pb_snapshots(limit=20):
+  # Refresh the oldest snapshots which are over a day old. This is limited per call, so that we don't burst SRC with requests.
+  for src_id in database.get_stale_pb_snapshots(seconds_since_epoch() - ONE_DAY, limit):
+    fetch_pb_snapshot(src_id) # If SRC is down, let the scheduler back off
+
+
+def get_personal_bests(src_id, src_game_ids):
+  # Full PBs (with embeds) in any of the given games
+  _, runs = get_pb_snapshot(src_id, full=True)
+  return [run for run in runs if run['run']['game'] in src_game_ids]
+
+
+def get_game(game_name):
+  # Games are looked up in the local catalog first, and SRC is only searched for names we haven't seen (recently).
+  # Searches are saved as aliases of the games they found, so repeating a search (even an ambiguous one) is answered locally.
+  games = database.find_catalog_games(game_name)
+  if games and all(seconds_since_epoch() < game.last_fetched + ONE_MONTH for game in games):
+    metrics.cache_requests.inc(cache='game_catalog', result='hit')
+  else:
+    metrics.cache_requests.inc(cache='game_catalog', result='miss')
+    j = make_request('GET', f'{api}/games', params={'name': game_name})
+    if len(j['data']) == 0:
+      error = f'Could not find game `{game_name}` on Speedrun.com'
+      if suggestions := database.suggest_catalog_games(game_name):
+        error += ' -- Did you mean one of these?\n' + ', '.join(f'`{suggestion}`' for suggestion in suggestions)
+      raise exceptions.CommandError(error)
+    games = [add_catalog_game(game, game_name) for game in j['data']]
+
+  if len(games) == 1:
+    return games[0]
+
+  possible_matches = []
+  for game in games:
+    possible_match = game.name
+    if possible_match == game_name: # If there are multiple options, but one is an exact match, return the exact match.
+      return game
+    possible_matches.append(f'`{possible_match}`')
+
+  suggestions = ', '.join(possible_matches[:10]) # Only show a max of 10 matches, for brevity's sake
+  raise exceptions.CommandError(f'Found {len(possible_matches)} possible matches for game `{game_name}` on Speedrun.com -- Try one of these options:\n' + suggestions)
+
+
+def add_catalog_game(game, search):
+  series_uri = next((link['uri'] for link in game.get('links', []) if link['rel'] == 'series'), None)
+  return database.add_catalog_game(
+    src_game_id=game['id'],
+    name=game['names']['international'],
+    aliases=[search, game['names'].get('japanese'), game.get('abbreviation')],
+    twitch_name=game['names'].get('twitch'),
+    src_series_id=series_uri.split('/api/v1/series/')[1] if series_uri else None,
+  )
+
+
+def search_src_user(username):
+  j = make_request('GET', f'{api}/users', params={'name': username})
+  if len(j['data']) == 0:
+    raise exceptions.CommandError(f'Could not find user `{username}` on Speedrun.com')
+
+  if len(j['data']) == 1:
+    return j['data'][0]['id']
+
+  possible_matches = []
+  for user in j['data']:
+    possible_match = user['names']['international']
+    if possible_match == username:
+      return user['id']
+    possible_matches.append(f'`{possible_match}`')
+
+  suggestions = ', '.join(possible_matches[:10]) # Only show a max of 10 matches, for brevity's sake
+  raise exceptions.CommandError(f'Found {len(possible_matches)} possible matches for user `{username}` on Speedrun.com -- Try one of these options:\n' + suggestions)
+
+
+def get_run_status(run_id):
+  j = make_request('GET', f'{api}/runs/{run_id}', allow_4xx=True)
+  if 'status' in j:
+    if j['status'] == 404:
+      return 'deleted'
+    else:
+      raise exceptions.NetworkError(f'Failed to load run {run_id}: {j["status"]} {j["message"]}') # e.g. rate limited
+
+  run_status = j['data']['status']['status']
+  if run_status == 'rejected':
+    return 'rejected'
+  elif run_status == 'verified':
+    return 'verified'
+
+  # The underlying SRC APIs do not actually 'delete' runs, they seem to simply unlink them in their database.
+  # Thus, a submission which is deleted by the runner will still show as 'new' (but not be returned by the get_runs call).
+  # Double-check that this run was deleted according to the frontend.
+  status_code, _ = make_head_request(j['data']['weblink'])
+  if status_code == 404:
+    return 'deleted'
+  else:
+    return run_status # probably 'new'
+
+
+def get_runs(**params):
+  if 'game' not in params and 'category' not in params:
+    raise exceptions.CommandError('You can only get Speedrun.com runs with a game or a category')
+
+  params['offset'] = 0
+  params['max'] = 100 # Undocumented parameter, gets 100 runs at once.
+  params['embed'] = embeds
+
+  runs = []
+  try:
+    j = make_request('GET', f'{api}/runs', params=params)
+    while 1:
+      runs += j['data']
+
+      next_link = next((link['uri'] for link in j['pagination']['links'] if link['rel'] == 'next'), None)
+      if next_link:
+        j = make_request('GET', next_link)
+        continue
+      break # No more results
+  except (exceptions.CircuitOpen, exceptions.DeadlineExceeded):
+    raise # Partial results would look like the missing runs were verified
+  except exceptions.NetworkError:
+    logging.exception(f'Failed to load runs for {params}, assuming empty')
+    return runs
+
+  return runs
+
+
+def get_leaderboard(game, category, level=None, variables=None):
+  params = {}
+  if variables is not None:
+    params = {f'var-{key}': value['id'] for key, value in variables.items()}
+  if level:
+    j = make_request('GET', f'{api}/leaderboards/{game}/level/{level}/{category}', params=params)
+  else:
+    j = make_request('GET', f'{api}/leaderboards/{game}/category/{category}', params=params)
+
+  # This does not support continue, so I assume it just reports the entire leaderboard.
+  for run in j['data']['runs']:
+    run['run']['place'] = run['place']
+    yield run['run']
+
+
+# NOTE: Run must be fetched with at least embed=category,category.variables
+# Returns a mapping of variable_id: {data}, where data is an arbitrary set of properties from SRC, including 'id'.
+def get_subcategories(run):
+  all_subcategories = {}
+  for variable in run['category']['data']['variables']['data']:
+    if not variable['is-subcategory']:
+      continue
+    all_subcategories[variable['id']] = variable['values']['values']
+
+  run_subcategories = {}
+  for variable_id, value_id in run['values'].items():
+    if variable_id not in all_subcategories:
+      continue # Not a subcategory
+
+    value = all_subcategories[variable_id][value_id]
+    value['id'] = value_id
+    run_subcategories[variable_id] = value
+
+  return run_subcategories
+
+
+def parse_name(player):
+  if 'names' in player:
+    return player['names']['international']
+  elif 'name' in player:
+    return player['name']
+  else:
+    return player['id']
+
+
+# NOTE: Run data must be fetched with embeds
+def get_current_pb(new_run):
+  game = new_run['game']['data']['id'] # Embedded
+  category = new_run['category']['data']['id']
+  players = set(parse_name(player) for player in new_run['players']['data'])
+  time = new_run['times']['primary_t']
+  level = new_run['level']['data']['id'] if isinstance(new_run['level']['data'], dict) else None
+
+  subcategories = get_subcategories(new_run)
+  try:
+    leaderboard = get_leaderboard(game, category, level, subcategories)
+  except exceptions.CircuitOpen:
+    return None
+  except exceptions.NetworkError:
+    logging.exception(f'Failed to load the leaderboard for {game}, assuming no existing PB')
+    return None
+
+  for run in leaderboard:
+    if 'place' not in new_run and time <= run['times']['primary_t']:
+      new_run['place'] = run['place']
+    if players == set(parse_name(player) for player in run['players']):
+      return run
+
+
+# NOTE: Run data must be fetched with embeds
+def run_to_string(run, current_pb=None):
+  game = run['game']['data']['names']['international']
+  category = run['category']['data']['name']
+
+  if isinstance(run['level']['data'], dict):
+    category = run['level']['data']['name'] + f': {category}'
+
+  subcategories = get_subcategories(run)
+  for value in subcategories.values():
+    category += f' ({value["label"]})'
+
+  time = timedelta(seconds=run['times']['primary_t'])
+
+  runners = ', '.join(map(parse_name, run['players']['data']))
+
+  output = f'`{game} | {category}` in {time} by {runners}'
+  if 'place' in run:
+    n = int(run['place'])
+    # https://stackoverflow.com/a/36977549
+    ordinal = {1:'st', 2:'nd', 3:'rd'}.get(n%100 if n%100<20 else n%10, 'th')
+    output += f', which would put them in {n}{ordinal} place'
+  if current_pb:
+    current_pb_time = timedelta(seconds=current_pb['times']['primary_t'])
+    n = int(current_pb['place'])
+    # https://stackoverflow.com/a/36977549
+    ordinal = {1:'st', 2:'nd', 3:'rd'}.get(n%100 if n%100<20 else n%10, 'th')
+    output += f'\nAn improvement over their current PB of {current_pb_time} ({n}{ordinal} place)'
+  output += f'\n<{run["weblink"]}>'
+  return output
+
+
+# Awaitable versions of the above, for use from the gateway's event loop.
+async def get_src_id_async(twitch_username):
+  return await run_async(get_src_id, twitch_username)
+
+
+async def runner_runs_game_async(twitch_username, src_id, src_game_id):
+  return await run_async(runner_runs_game, twitch_username, src_id, src_game_id)
+
+
+async def get_personal_bests_async(src_id, src_game_ids):
+  return await run_async(get_personal_bests, src_id, src_game_ids)
+
+
+async def get_game_async(game_name):
+  return await run_async(get_game, game_name)
+
+
+async def search_src_user_async(username):
+  return await run_async(search_src_user, username)
+
+
+async def get_run_status_async(run_id):
+  return await run_async(get_run_status, run_id)
+
+
+async def get_runs_async(**params):
+  return await run_async(get_runs, **params)
+
+
+async def get_current_pb_async(new_run):
+  return await run_async(get_current_pb, new_run)
+
+
+# Undocumented PHP APIs, that I apparently *am* allowed to call.
+# https://discord.com/channels/157645920324943872/343897241766854656/902321525263319110
+# (Can't access it, but the image says "no support nor api stability provided")
+# Hopefully they stop using numeric IDs.
+
+# Get latest runs for a game series (note: needs numeric ID, which comes from ???)
+# https://www.speedrun.com/ajax_latestleaderboard.php?series=18748
+# Get latest runs for all games (personalized if signed in)
+# https://www.speedrun.com/ajax_latestleaderboard.php?amount=100
+# Get the latest runs for a set of games (note: needs numeric IDs)
+# https://www.speedrun.com/ajax_latestleaderboard.php?games=1545,1546,1547,4158,1548,1549,2147,2048,2222,2223,2224,6353,2225,7967
+
+# Get game streams
+# https://www.speedrun.com/ajax_streams.php?game=talos_principle&country=&haspb=on&following=off&start=0
+
+
+# Edit run / Submit run
+# When you submit a run, you are granted an ID (temporary, I assume) on page load. It lives in the <form id="editform"> object, and NOWHERE ELSE.
+# Also, you are given a CSRF token, as a <meta> attribute, and also inside a few <input type="hidden" name="csrftoken"> objects.
+# playerselect=0 means "I am an admin, I was not part of this run". Otherwise, 1-4 means "I was player # whatever".
+# The variable IDs are visible in the page HTML, if nothing else.
+# POST https://www.speedrun.com/ajax_editrun.php?id=abcd1234&game=2364&action=submit
+# category=All_Sigils
+# &player1=foo&playerselect=0
+# &hour=1&minute=4&second=23&milliseconds=
+# &loadshour=1&loadsminute=4&loadssecond=23&loadsmilliseconds=
+# &variable16422=54487
+# &variable12500=42106
+# &platform=31
+# &date=2021-06-12
+# &video=https%3A%2F%2Fwww.youtube.com%2Fwatch%3Fv%3Dsomething
+# &splitsio=
+# &comment=URL+encoded+comment%0D%0AWith+Octets
+# &csrftoken=probably-important
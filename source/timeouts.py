@@ -0,0 +1,146 @@
+import logging
+import os
+import socket
+from contextlib import contextmanager
+from threading import Lock, Timer, local
+from time import monotonic
+
+import requests
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+from . import metrics
+
+# Every request gets a (connect, read) timeout, so that a hung connection fails instead of blocking its thread (and with it, a job) forever.
+# The read timeout applies to each wait for data, not the whole response. Inside a job, both are also capped to the job's remaining budget.
+# Policies are matched in order on host and path prefix. Hosts which aren't listed (e.g. in tests) get the default.
+POLICIES = [
+  ('www.speedrun.com', '/api/v1/leaderboards/', (5, 30)), # Full leaderboards (with embeds) are slow to build
+  ('www.speedrun.com', '/api/v1/runs', (5, 30)), # Pages of 100 runs with embeds
+  ('www.speedrun.com', '', (5, 15)),
+  ('api.twitch.tv', '', (3, 10)),
+  ('id.twitch.tv', '', (3, 10)),
+  ('static-cdn.jtvnw.net', '', (3, 5)), # Stream previews are HEAD requests, which should be quick
+  ('discord.com', '', (3, 10)),
+]
+DEFAULT = (5, 30)
+
+def get_timeout(host, path):
+  for policy_host, prefix, timeout in POLICIES:
+    if host == policy_host and path.startswith(prefix):
+      return timeout
+  return DEFAULT
+
+
+def get_deadline(host, path):
+  # The total time for a call outside of a job (e.g. from a command), including retries and backoff: enough for the request and one retry.
+  connect, read = get_timeout(host, path)
+  return 2 * (connect + read)
+
+
+def cap(timeout, seconds):
+  # Limit both parts of a timeout to the time left before a deadline
+  return tuple(min(part, seconds) for part in timeout)
+
+
+# The read timeout applies to each read from the socket, so a server which sends its response very slowly (e.g. a byte a second)
+# never triggers it. Instead, while a request is in flight, a watchdog shuts down its connection once the deadline passes,
+# which fails the read in progress. Connections are found by the pools below, which note each one they hand out to this thread.
+in_flight = local()
+
+class Watchdog():
+  def __init__(self, seconds):
+    self.connections = []
+    self.expired = False
+    self.timer = Timer(seconds, self.expire)
+    self.timer.daemon = True
+
+  def expire(self):
+    self.expired = True
+    for connection in self.connections:
+      if sock := connection.sock:
+        try:
+          socket.socket.shutdown(sock, socket.SHUT_RDWR) # Not SSLSocket.shutdown, which would also tear down the TLS state under the reader
+        except OSError:
+          pass # Already closed
+
+
+@contextmanager
+def watchdog(seconds):
+  dog = Watchdog(seconds)
+  in_flight.connections = dog.connections
+  dog.timer.start()
+  try:
+    yield dog
+  finally:
+    dog.timer.cancel()
+    in_flight.connections = None
+
+
+class WatchedPool():
+  def _get_conn(self, timeout=None):
+    connection = super()._get_conn(timeout)
+    if (connections := getattr(in_flight, 'connections', None)) is not None:
+      connections.append(connection)
+    return connection
+
+class WatchedHTTPConnectionPool(WatchedPool, HTTPConnectionPool):
+  pass
+
+class WatchedHTTPSConnectionPool(WatchedPool, HTTPSConnectionPool):
+  pass
+
+
+# TCP keepalive on pooled connections, so that a connection which died while idle (e.g. a NAT dropped it) is noticed
+# by the OS within a couple of minutes, rather than by the next request's read timeout. Not every platform supports all options.
+KEEPALIVE_OPTIONS = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+for name, value in [('TCP_KEEPIDLE', 60), ('TCP_KEEPINTVL', 10), ('TCP_KEEPCNT', 3)]:
+  if hasattr(socket, name):
+    KEEPALIVE_OPTIONS.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+
+class KeepaliveAdapter(requests.adapters.HTTPAdapter):
+  def init_poolmanager(self, *args, **kwargs):
+    kwargs['socket_options'] = HTTPConnection.default_socket_options + KEEPALIVE_OPTIONS
+    super().init_poolmanager(*args, **kwargs)
+    self.poolmanager.pool_classes_by_scheme = {'http': WatchedHTTPConnectionPool, 'https': WatchedHTTPSConnectionPool} # See watchdog
+
+
+# Optional caching of DNS results, for systems without a caching resolver, where each new connection otherwise waits on a lookup.
+# Enable by setting SPEEDRUNBOT_DNS_CACHE to the number of seconds to cache results for. If a lookup fails, the expired result is used.
+dns_ttl = float(os.environ.get('SPEEDRUNBOT_DNS_CACHE', '0'))
+dns_cache = {} # (getaddrinfo arguments): (expiry time, result)
+dns_lock = Lock()
+uncached_getaddrinfo = socket.getaddrinfo
+
+def cached_getaddrinfo(*args, **kwargs):
+  key = (args, tuple(sorted(kwargs.items())))
+  with dns_lock:
+    entry = dns_cache.get(key)
+  if entry and monotonic() < entry[0]:
+    metrics.cache_requests.inc(cache='dns', result='hit')
+    return entry[1]
+
+  metrics.cache_requests.inc(cache='dns', result='miss')
+  try:
+    result = uncached_getaddrinfo(*args, **kwargs)
+  except socket.gaierror:
+    if not entry:
+      raise
+    logging.warning('DNS lookup for %s failed, using the expired result', args[0])
+    return entry[1]
+  with dns_lock:
+    dns_cache[key] = (monotonic() + dns_ttl, result)
+  return result
+
+
+def enable_dns_cache(ttl=None):
+  global dns_ttl
+  if ttl is not None:
+    dns_ttl = ttl
+  socket.getaddrinfo = cached_getaddrinfo # Also used by urllib3 and websockets, which look it up on the socket module at call time
+
+
+def disable_dns_cache():
+  socket.getaddrinfo = uncached_getaddrinfo
+  with dns_lock:
+    dns_cache.clear()
@@ -1,103 +1,239 @@
-import logging
-from pathlib import Path
-
-from . import exceptions
-from .make_request import make_request, make_head_request
-from .utils import parse_time, seconds_since_epoch
-
-api = 'https://api.twitch.tv/helix'
-
-cached_headers = (None, 0)
-def get_headers():
-  global cached_headers
-  if cached_headers[1] < seconds_since_epoch():
-    with Path(__file__).with_name('twitch_token.txt').open() as f:
-      token = f.read().strip()
-    with Path(__file__).with_name('twitch_client.txt').open() as f:
-      client_id = f.read().strip()
-
-    j = make_request('POST', 'https://id.twitch.tv/oauth2/token', params={
-      'grant_type': 'client_credentials',
-      'client_id': client_id,
-      'client_secret': token,
-    })
-    cached_headers = ({
-      'client-id': client_id,
-      'Authorization': 'Bearer ' + j['access_token']
-    }, seconds_since_epoch() + 60*60*24*30)
-  return cached_headers[0]
-
-
-# game_ids is an array of twitch game ids. (max: 100)
-def get_live_streams(*, game_ids=None, user_logins=None):
-  params = {'first': 100}
-  if game_ids != None:
-    if len(game_ids) == 0 or len(game_ids) > 100:
-      raise exceptions.CommandError(f'Invalid number of game_ids: {len(game_ids)}')
-    if user_logins:
-      raise exceptions.CommandError('Cannot combine both game_ids and user_logins')
-
-    params['game_id'] = game_ids
-  elif user_logins != None:
-    if len(user_logins) == 0 or len(user_logins) > 100:
-      raise exceptions.CommandError(f'Invalid number of user_logins: {len(user_logins)}')
-
-    params['user_login'] = user_logins
-  else:
-    raise exceptions.CommandError('Must provide one of game_ids or user_logins')
-
-  while 1:
-    j = make_request('GET', f'{api}/streams', params=params, get_headers=get_headers)
-    data = j.get('data')
-    if not data: # None or []
-      break
-
-    for stream in data:
-      if stream['type'] == 'live':
-        yield {
-          'preview': stream['thumbnail_url'].format(width=1920, height=1080),
-          'url': 'https://www.twitch.tv/' + stream['user_name'],
-          'name': stream['user_name'],
-          'title': stream['title'],
-          'viewcount': stream['viewer_count'],
-          'game': stream['game_name'],
-          'twitch_game_id': stream['game_id'],
-        }
-
-
-    cursor = j['pagination'].get('cursor')
-    if not cursor:
-      break
-    params['after'] = cursor
-
-
-def get_game_id(game_name):
-  j = make_request('GET', f'{api}/games', params={'name': game_name}, get_headers=get_headers)
-  if len(j['data']) == 0:
-    raise exceptions.CommandError(f'Could not find game `{game_name}` on Twitch')
-  return j['data'][0]['id']
-
-
-def get_user_id(username):
-  j = make_request('GET', f'{api}/users', params={'login': username}, get_headers=get_headers)
-  if len(j['data']) == 0:
-    raise exceptions.CommandError(f'Could not find user `{username}` on Twitch')
-  return j['data'][0]['id']
-
-
-def get_preview_metadata(preview_url):
-  try:
-    status_code, headers = make_head_request(preview_url)
-    expires = parse_time(headers['expires'], '%a, %d %b %Y %H:%M:%S %Z')
-
-    return {
-      'redirect': status_code >= 300 and status_code < 400,
-      'expires': expires.timestamp(),
-    }
-  except exceptions.NetworkError:
-    logging.exception(f'Failed to fetch stream metadata for {preview_url}, assuming still online')
-    return {
-      'redirect': False, # Stream has not gone offline
-      'expires': seconds_since_epoch(), # Data expires immediately
-    }
-
+import contextvars
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from threading import Lock
+
+from . import database, exceptions
+from .make_request import make_request, make_head_request, run_async
+from .records import Stream
+from .utils import parse_time, seconds_since_epoch
+
+api = 'https://api.twitch.tv/helix'
+token_api = 'https://id.twitch.tv/oauth2/token'
+REFRESH_MARGIN = 24 * 60 * 60 # Refresh the app token this long before it expires, so that we never make a call with an expired token.
+
+client_credentials = None # (client_id, client_secret), read from disk once
+cached_headers = (None, 0) # (headers, expiry time)
+token_lock = Lock() # Held while minting a token, so that concurrent callers don't each mint their own.
+
+def get_client_credentials():
+  global client_credentials
+  if not client_credentials:
+    with Path(__file__).with_name('twitch_client.txt').open() as f:
+      client_id = f.read().strip()
+    with Path(__file__).with_name('twitch_token.txt').open() as f:
+      client_secret = f.read().strip()
+    client_credentials = (client_id, client_secret)
+  return client_credentials
+
+
+def get_headers(refresh=False):
+  headers, expires = cached_headers
+  if not refresh and seconds_since_epoch() < expires:
+    return headers # Fast path, no locking required
+
+  with token_lock:
+    if not refresh and seconds_since_epoch() < cached_headers[1]:
+      return cached_headers[0] # Another thread refreshed the token while we were waiting for the lock
+    return refresh_headers(force=refresh)
+
+
+# NOTE: Must be called with token_lock held.
+def refresh_headers(force=False):
+  global cached_headers
+  client_id, client_secret = get_client_credentials()
+  service = f'twitch:{client_id}' # Tokens are only valid for the client which minted them
+
+  # Tokens are persisted in the database, so that restarting the bot doesn't require minting a new one.
+  token, expires = database.get_app_token(service)
+  margin = REFRESH_MARGIN
+  if force or seconds_since_epoch() + margin > expires:
+    j = make_request('POST', token_api, params={
+      'grant_type': 'client_credentials',
+      'client_id': client_id,
+      'client_secret': client_secret,
+    })
+    token = j['access_token']
+    expires = seconds_since_epoch() + j['expires_in']
+    database.set_app_token(service, token, expires)
+    logging.info(f'Minted a new twitch app token, which expires in {j["expires_in"]} seconds')
+    margin = min(REFRESH_MARGIN, j['expires_in'] / 10) # In case twitch ever gives out short-lived tokens
+
+  # Consider the token expired a bit early, so that get_headers comes back here to refresh it (even without refresh_headers_job).
+  cached_headers = ({
+    'client-id': client_id,
+    'Authorization': 'Bearer ' + token,
+  }, expires - margin)
+  return cached_headers[0]
+
+
+# Scheduled job which refreshes the token before it expires, so that polling never has to wait on the token API.
+def refresh_headers_job():
+  with token_lock:
+    if seconds_since_epoch() >= cached_headers[1]:
+      refresh_headers()
+
+
+# game_ids is an array of twitch game ids. (max: 100, see get_live_streams_sharded for more)
+def get_live_streams(*, game_ids=None, user_logins=None):
+  params = {'first': 100}
+  if game_ids != None:
+    if len(game_ids) == 0 or len(game_ids) > 100:
+      raise exceptions.CommandError(f'Invalid number of game_ids: {len(game_ids)}')
+    if user_logins:
+      raise exceptions.CommandError('Cannot combine both game_ids and user_logins')
+
+    params['game_id'] = game_ids
+  elif user_logins != None:
+    if len(user_logins) == 0 or len(user_logins) > 100:
+      raise exceptions.CommandError(f'Invalid number of user_logins: {len(user_logins)}')
+
+    params['user_login'] = user_logins
+  else:
+    raise exceptions.CommandError('Must provide one of game_ids or user_logins')
+
+  while 1:
+    j = make_request('GET', f'{api}/streams', params=params, get_headers=get_headers)
+    data = j.get('data')
+    if not data: # None or []
+      break
+
+    for stream in data:
+      if stream['type'] == 'live':
+        yield Stream.from_helix(stream)
+
+
+    cursor = j['pagination'].get('cursor')
+    if not cursor:
+      break
+    params['after'] = cursor
+
+
+# Helix only accepts 100 game_ids or user_logins per call, so larger requests are split into shards.
+# Shards are fetched concurrently on a small, dedicated pool: 4 concurrent requests keep us well inside Helix's 800 requests/minute.
+MAX_SHARD_SIZE = 100
+shard_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='helix')
+
+def get_live_streams_sharded(*, game_ids=None, user_logins=None):
+  if game_ids != None and user_logins:
+    raise exceptions.CommandError('Cannot combine both game_ids and user_logins')
+  key = 'game_ids' if game_ids != None else 'user_logins'
+  ids = list(dict.fromkeys(game_ids if game_ids != None else user_logins or [])) # Remove duplicates, but preserve order
+  if len(ids) == 0:
+    return
+
+  def fetch_shard(shard):
+    return list(get_live_streams(**{key: shard}))
+
+  shards = [ids[i:i+MAX_SHARD_SIZE] for i in range(0, len(ids), MAX_SHARD_SIZE)]
+  futures = [shard_executor.submit(contextvars.copy_context().run, fetch_shard, shard) for shard in shards] # Shards share the caller's budget
+
+  # Streams can show up twice, either in two shards (after a game change) or in two pages (if the viewer-count ordering shifts mid-pagination)
+  seen_streams = set()
+  for future in as_completed(futures):
+    for stream in future.result():
+      if stream.name not in seen_streams:
+        seen_streams.add(stream.name)
+        yield stream
+
+
+def get_game_id(game_name):
+  if twitch_game_id := database.get_twitch_game_id(game_name):
+    return twitch_game_id # Twitch IDs never change, so these are cached forever in the game catalog.
+
+  j = make_request('GET', f'{api}/games', params={'name': game_name}, get_headers=get_headers)
+  if len(j['data']) == 0:
+    raise exceptions.CommandError(f'Could not find game `{game_name}` on Twitch')
+  twitch_game_id = j['data'][0]['id']
+  database.set_twitch_game_id(game_name, twitch_game_id)
+  return twitch_game_id
+
+
+def get_user_id(username):
+  j = make_request('GET', f'{api}/users', params={'login': username}, get_headers=get_headers)
+  if len(j['data']) == 0:
+    raise exceptions.CommandError(f'Could not find user `{username}` on Twitch')
+  return j['data'][0]['id']
+
+
+def get_user_ids(usernames):
+  # Like get_user_id, but for many users at once (100 per call). Users who aren't found are omitted.
+  user_ids = {}
+  usernames = list(usernames)
+  for i in range(0, len(usernames), 100):
+    j = make_request('GET', f'{api}/users', params={'login': usernames[i:i+100]}, get_headers=get_headers)
+    for user in j['data']:
+      user_ids[user['login']] = user['id']
+  return user_ids
+
+
+def get_eventsub_subscriptions():
+  params = {}
+  while 1:
+    j = make_request('GET', f'{api}/eventsub/subscriptions', params=params, get_headers=get_headers)
+    yield from j['data']
+
+    cursor = j['pagination'].get('cursor')
+    if not cursor:
+      break
+    params['after'] = cursor
+
+
+def create_eventsub_subscription(subscription_type, version, broadcaster_user_id, callback, secret):
+  body = {
+    'type': subscription_type,
+    'version': version,
+    'condition': {'broadcaster_user_id': broadcaster_user_id},
+    'transport': {'method': 'webhook', 'callback': callback, 'secret': secret},
+  }
+  j = make_request('POST', f'{api}/eventsub/subscriptions', allow_4xx=True, json=body, get_headers=get_headers)
+  if 'error' in j:
+    # 409 Conflict means we're already subscribed, which is fine.
+    logging.error(f'Failed to subscribe to {subscription_type} for {broadcaster_user_id}: {j}')
+    return False
+  return True
+
+
+def delete_eventsub_subscription(subscription_id):
+  make_request('DELETE', f'{api}/eventsub/subscriptions', params={'id': subscription_id}, get_headers=get_headers)
+
+
+def get_preview_metadata(preview_url):
+  try:
+    status_code, headers = make_head_request(preview_url)
+    expires = parse_time(headers['expires'], '%a, %d %b %Y %H:%M:%S %Z')
+
+    return {
+      'redirect': status_code >= 300 and status_code < 400,
+      'expires': expires.timestamp(),
+    }
+  except exceptions.CircuitOpen:
+    pass # The CDN is known to be down (see circuit_breakers.py), so check again once it recovers
+  except exceptions.DeadlineExceeded:
+    pass # The tick is out of time, so check again next tick
+  except exceptions.NetworkError:
+    logging.exception(f'Failed to fetch stream metadata for {preview_url}, assuming still online')
+  return {
+    'redirect': False, # Stream has not gone offline
+    'expires': seconds_since_epoch(), # Data expires immediately
+  }
+
+
+
+# Awaitable versions of the above, for use from the gateway's event loop.
+async def get_live_streams_async(*, game_ids=None, user_logins=None):
+  # Generators can't cross threads, so the stream list is collected on the pool.
+  return await run_async(lambda: list(get_live_streams(game_ids=game_ids, user_logins=user_logins)))
+
+
+async def get_game_id_async(game_name):
+  return await run_async(get_game_id, game_name)
+
+
+async def get_user_id_async(username):
+  return await run_async(get_user_id, username)
+
+
+async def get_preview_metadata_async(preview_url):
+  return await run_async(get_preview_metadata, preview_url)